@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of expression matching and of the processor hot path.
+Keys are synthetic and handlers are dummy, so neither X server nor
+device is needed. Run from the repository root:
+
+    python benchmarks/bench.py [--quick] [--save FILE] [--compare FILE]
+
+Latencies are per key, in microseconds. "gc" is the net number of
+container objects left allocated per key, as counted by the collector.
+"""
+from argparse import ArgumentParser
+import gc
+from json import dump, dumps, load
+import os
+from random import Random
+import sys
+from tempfile import mkstemp
+from timeit import default_timer
+from evdev import ecodes, InputEvent, KeyEvent
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pybd.expression import Expression, Translator
+from pybd.processor import Processor
+
+__author__ = 'iljich'
+
+END_KEY = "TOUCH"
+RESET_KEY = "TOOL_PEN"
+
+# buttons translate to chars without X server
+Translator.set_device_type("button")
+NAMES = sorted(name for code, name in Translator.name_table().items()
+               if name not in (END_KEY, RESET_KEY))
+random = Random(0)
+
+def key(name, state=KeyEvent.key_down):
+    return KeyEvent(InputEvent(0, 0, ecodes.EV_KEY, Translator.char_to_code(name), state))
+
+def press(names):
+    return [key(name, state) for name in names
+            for state in (KeyEvent.key_down, KeyEvent.key_up)]
+
+def pattern(names):
+    return "".join("<%s>" % name for name in names)
+
+def random_names(length):
+    return [random.choice(NAMES) for i in range(length)]
+
+def processor(patterns):
+    config = {
+        "processor": {
+            "reset_key": "<%s>" % RESET_KEY,
+            "input_end_key": "<%s>" % END_KEY,
+            "loglevel": "WARN",
+            "workers": 1,
+            "queue_size": 1000000,
+            "buffer_size": 1000000,
+        },
+        "expressions": {"default": {"dummy": dict((p, "") for p in patterns)}},
+    }
+    fd, path = mkstemp(suffix=".conf")
+    with os.fdopen(fd, "w") as f:
+        f.write(dumps(config))
+    try:
+        p = Processor(path, start=False)
+    finally:
+        os.unlink(path)
+    session = p.add_session()
+    return lambda event: p.handle_event(event, session)
+
+def measure(function, inputs):
+    latencies = []
+    gc.collect()
+    gc.disable()
+    objects = gc.get_count()[0]
+    try:
+        for item in inputs:
+            start = default_timer()
+            function(item)
+            latencies.append(default_timer() - start)
+        objects = gc.get_count()[0] - objects
+    finally:
+        gc.enable()
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1e6
+    return {
+        "keys": len(latencies),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": latencies[-1] * 1e6,
+        "gc": float(objects) / len(latencies),
+    }
+
+def bench_bindings(counts, keys):
+    for count in counts:
+        patterns = set()
+        while len(patterns) < count:
+            patterns.add(pattern(random_names(4)))
+        yield "bindings/%d" % count, processor(patterns), press(random_names(keys))
+
+def bench_pattern_length(lengths, keys):
+    for length in lengths:
+        patterns = [random_names(length) for i in range(100)]
+        events = []
+        while len(events) < keys:
+            events += press(random.choice(patterns))
+        yield "pattern_length/%d" % length, processor(map(pattern, patterns)), events
+
+def bench_wildcard(lengths, keys):
+    for length in lengths:
+        patterns = [pattern(random_names(3)) for i in range(100)] + ["<%s>*" % NAMES[0]]
+        events = []
+        while len(events) < keys:
+            events += press([NAMES[0]] + random_names(length) + [END_KEY])
+        yield "wildcard/%d" % length, processor(patterns), events
+
+def bench_buffer_depth(depths, keys):
+    # one long partial match, every key makes buffer one key deeper
+    for depth in depths:
+        names = random_names(depth + keys / 2 + 1)
+        handle = processor([pattern(names)])
+        for event in press(names[:depth]):
+            handle(event)
+        yield "buffer_depth/%d" % depth, handle, press(names[depth:-1])
+
+def bench_expression(depths, keys):
+    # Expression.process rescans whole buffer, ExpressionState does not
+    for depth in depths:
+        names = random_names(depth)
+        expression = Expression(pattern(names) + "*", "<%s>" % END_KEY)
+        buffer = press(names) + [key(NAMES[0])]
+        yield "expression_process/%d" % depth, expression.process, [buffer] * keys
+        state = expression.start()
+        for event in buffer:
+            state.advance(event)
+        yield "expression_state/%d" % depth, state.advance, [buffer[-1]] * keys
+
+def bench_parse(lengths, count):
+    # pattern to tokens, as done for every binding of config on load
+    for length in lengths:
+        patterns = [pattern(random_names(length)) for i in range(count)]
+        yield "parse/%d" % length, lambda p: Expression(p, "<%s>" % END_KEY), patterns
+
+def run(quick=False):
+    scale = (lambda full, short: short) if quick else (lambda full, short: full)
+    keys = scale(5000, 500)
+    benches = [
+        bench_bindings(scale([10, 100, 1000, 10000], [10, 1000]), keys),
+        bench_pattern_length(scale([1, 4, 16, 64], [1, 16]), keys),
+        bench_wildcard(scale([10, 100, 1000], [10, 100]), keys),
+        bench_buffer_depth(scale([10, 100, 1000], [10, 100]), 100),
+        bench_expression(scale([10, 100, 1000], [10, 100]), scale(1000, 100)),
+        bench_parse(scale([4, 64, 1000], [4, 64]), scale(10000, 1000)),
+    ]
+    results = {}
+    print "%-26s %7s %9s %9s %9s %9s %7s" % ("benchmark", "keys", "p50", "p90", "p99", "max", "gc")
+    for bench in benches:
+        for name, function, inputs in bench:
+            result = results[name] = measure(function, inputs)
+            print "%-26s %7d %9.1f %9.1f %9.1f %9.1f %7.2f" % (name, result["keys"],
+                result["p50"], result["p90"], result["p99"], result["max"], result["gc"])
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, expected in sorted(baseline.items()):
+        if name not in results:
+            continue
+        for stat in ("p50", "p99"):
+            if results[name][stat] > expected[stat] * (1 + tolerance):
+                regressions.append("%s %s: %.1f -> %.1f" % (name, stat, expected[stat], results[name][stat]))
+    return regressions
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smaller sweeps")
+    parser.add_argument("--save", help="write results as json baseline")
+    parser.add_argument("--compare", help="baseline to compare results with")
+    parser.add_argument("--tolerance", type=float, default=0.5,
+        help="allowed slowdown against baseline, 0.5 is 50%%")
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    if args.save:
+        with open(args.save, "w") as f:
+            dump(results, f, indent=4, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, load(f), args.tolerance)
+        for regression in regressions:
+            print "regression: %s" % regression
+        sys.exit(1 if regressions else 0)
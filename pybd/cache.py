@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from hashlib import sha1
+from json import dumps
+import logging
+import marshal
+import os
+from evdev import ecodes
+from pybd.expression import Translator
+
+__author__ = 'iljich'
+
+class MatcherCache(object):
+    """
+    Compiled namespaces, kept in a file between runs: keys of bindings in
+    order, tokens of their patterns and tables of the prefix tree, see
+    Matcher.tables. Namespace of unchanged config is loaded from there
+    without parsing patterns, resolving key names or building the tree.
+    Entries are stamped with config of the namespace, input end key, format,
+    device type and key codes known to evdev; outdated ones are compiled again.
+    """
+    version = 2
+
+    def __init__(self, path):
+        self.path = path
+        # namespace -> (stamp, keys, tokens, tables)
+        self.namespaces = {}
+        self.changed = False
+        self.load()
+
+    def stamp(self, expressions, wildchar):
+        codes = sorted(ecodes.ecodes.items())
+        # config is dumped as json, so str and unicode of it are the same
+        return sha1(repr((self.version, dumps([expressions, wildchar], sort_keys=True),
+                          Translator.device, codes))).hexdigest()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as f:
+                version, namespaces = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            logging.info("matcher cache %s is not used: %s", self.path, e)
+            return
+        if version == self.version:
+            self.namespaces = namespaces
+        else:
+            logging.info("matcher cache %s is outdated", self.path)
+
+    def get(self, namespace, expressions, wildchar):
+        """keys, tokens and tables of namespace compiled from `expressions`, None if not cached"""
+        entry = self.namespaces.get(namespace)
+        if entry and entry[0] == self.stamp(expressions, wildchar):
+            return entry[1:]
+        return None
+
+    def put(self, namespace, expressions, wildchar, keys, tokens, tables):
+        self.namespaces[namespace] = (self.stamp(expressions, wildchar), keys, tokens, tables)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        temp = "%s.%d" % (self.path, os.getpid())
+        try:
+            with open(temp, "wb") as f:
+                marshal.dump((self.version, self.namespaces), f)
+            # readers see either old file or new one, never a half written
+            os.rename(temp, self.path)
+            self.changed = False
+        except (IOError, OSError) as e:
+            logging.warning("matcher cache %s is not saved: %s", self.path, e)
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+from json import dumps, loads
+import os
+from socket import error as SocketError
+from time import time
+from pybd.device import KeyRecord
+from pybd.expression import Expression, Translator
+from pybd.utils import Connection, unix_server
+
+__author__ = 'iljich'
+
+class Control(object):
+    """
+    Commands to the running processor over a unix socket, served from its
+    main loop. Every line is a json object like {"cmd": "press", "keys": "mr"},
+    or a list of them run in order; it is answered by a line with reply
+    {"ok": result} or {"error": message}, or a list of replies, sent
+    without waiting for the client. Socket is accessible by owner only,
+    as it can run any binding.
+    """
+
+    def __init__(self, processor, path):
+        self.processor = processor
+        self.path = path
+        self.server = unix_server(path, 0600)
+        self.connections = []
+        processor.listen(self.server, self.accept)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        self.server.close()
+        os.unlink(self.path)
+
+    def accept(self):
+        try:
+            connection = self.server.accept()[0]
+        except SocketError:
+            return
+        # unfinished line of the connection
+        rest = [""]
+        self.connections = [c for c in self.connections if not c.closed]
+        self.connections.append(Connection(self.processor, connection, lambda data: self.receive(rest, data)))
+
+    def receive(self, rest, data):
+        lines = (rest[0] + data).split("\n")
+        rest[0] = lines.pop()
+        return "".join(self.execute_line(line) + "\n" for line in lines if line.strip())
+
+    def execute_line(self, line):
+        try:
+            request = loads(line)
+        except ValueError as e:
+            return dumps({"error": "not valid json: %s" % e})
+        if isinstance(request, list):
+            return dumps([self.execute(item) for item in request])
+        return dumps(self.execute(request))
+
+    def execute(self, request):
+        try:
+            args = dict((str(name), value) for name, value in request.items())
+            command = getattr(self, "do_%s" % args.pop("cmd"), None)
+            if command is None:
+                raise ValueError("no such command: %s" % request["cmd"])
+            return {"ok": command(**args)}
+        except Exception as e:
+            return {"error": "%s: %s" % (e.__class__.__name__, e)}
+
+    def session(self, device):
+        if not 0 <= device < len(self.processor.sessions):
+            raise ValueError("no device %s" % device)
+        return self.processor.sessions[device]
+
+    def do_press(self, keys, device=0):
+        """presses and releases keys, written as in expressions, e.g. "mr<ENTER>" """
+        session = self.session(device)
+        if self.processor.backlog is not None:
+            raise ValueError("expressions are not compiled yet")
+        codes = []
+        wildchar = self.processor.config["processor"]["input_end_key"] or "<ENTER>"
+        for kind, code in Expression(keys, wildchar).tokens:
+            if kind != "button" or code is None:
+                raise ValueError("not a key in %s" % keys)
+            codes.append(code)
+        for code in codes:
+            stamp = time()
+            sec, usec = int(stamp), int(stamp % 1 * 1000000)
+            self.processor.handle_event(KeyRecord(code, 1, sec, usec), session)
+            self.processor.handle_event(KeyRecord(code, 0, sec, usec), session)
+        return len(codes)
+
+    def do_state(self):
+        return {
+            "devices": [{
+                "device": session.device and session.device.path,
+                "namespace": session.namespace,
+                "buffer": [(Translator.key_to_name(key), key.keystate) for key in session.event_buffer],
+                "threads": len(session.matcher.threads) if session.matcher else 0,
+            } for session in self.processor.sessions],
+            "namespaces": list(self.processor.namespaces),
+            "backlog": len(self.processor.backlog or []),
+            "handlers_pending": self.processor.pool.depth(),
+        }
+
+    def do_namespace(self, name, device=0):
+        session = self.session(device)
+        if self.processor.backlog is not None:
+            raise ValueError("expressions are not compiled yet")
+        if not self.processor.switch_namespace(session, name):
+            raise ValueError("no namespace %s" % name)
+        return name
+
+    def do_reload(self):
+        # done by the main loop, right after this command
+        self.processor.schedule_reload()
+        return "scheduled"
+
+    def do_toggle(self, device=0):
+        session = self.session(device)
+        if session.device is None:
+            raise ValueError("session %s has no device" % device)
+        session.device.toggle()
+        return session.device.get_state()
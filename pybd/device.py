@@ -1,16 +1,179 @@
 # -*- coding: utf-8 -*-
-from re import search, findall
-from subprocess import Popen, PIPE, check_call
+from array import array
+from collections import namedtuple
+from fcntl import ioctl
+from io import FileIO
+import logging
+from struct import Struct
+from evdev import ecodes
 from evdev.device import InputDevice
 from evdev.util import list_devices
+from Xlib import X, Xatom
+from Xlib.error import DisplayError
+from Xlib.ext import xinput
+from pybd.expression import Translator
 
 __author__ = 'iljich'
 
 class DeviceError(Exception):
     pass
 
+def switch(value):
+    """config switch, true or false, 1 or 0, also as string like default_state, to bool"""
+    if value not in (True, False, "1", "0"):
+        raise ValueError("switch is true, false, 1 or 0, not %r" % (value,))
+    return value in (True, "1")
+
+XDevice = namedtuple("XDevice", ["xid", "name", "use", "path"])
+
+class XInput(object):
+    """
+    Talks to XInput extension of X server directly, instead of running xinput.
+    Device list is cached until `refresh`.
+    """
+    inventory = None
+    uses = {
+        "keyboard": (xinput.MasterKeyboard, xinput.SlaveKeyboard, xinput.FloatingSlave),
+        "pointer": (xinput.MasterPointer, xinput.SlavePointer, xinput.FloatingSlave),
+    }
+
+    @classmethod
+    def available(cls):
+        try:
+            return Translator.open_display().has_extension("XInputExtension")
+        except DisplayError:
+            return False
+
+    @classmethod
+    def atom(cls, name):
+        return Translator.display.intern_atom(name)
+
+    @classmethod
+    def devices(cls):
+        if cls.inventory is None:
+            display = Translator.open_display()
+            node = cls.atom("Device Node")
+            cls.inventory = []
+            for info in display.xinput_query_device(xinput.AllDevices).devices:
+                reply = display.xinput_get_device_property(info.deviceid, node,
+                                                           X.AnyPropertyType, 0, 1024)
+                path = reply.value[1].rstrip("\0") if reply.value else None
+                cls.inventory.append(XDevice(info.deviceid, info.name, info.use, path))
+        return cls.inventory
+
+    @classmethod
+    def refresh(cls):
+        cls.inventory = None
+
+    @classmethod
+    def find(cls, xid=None, name=None, path=None, uses=None):
+        return [device for device in cls.devices()
+                if (xid is None or device.xid == xid)
+                    and (name is None or device.name == name)
+                    and (path is None or device.path == path)
+                    and (uses is None or device.use in uses)]
+
+    @classmethod
+    def check(cls, xid):
+        try:
+            if cls.find(xid=int(xid)):
+                return int(xid)
+        except ValueError:
+            pass
+        raise DeviceError("No device with id %s" % xid)
+
+    @classmethod
+    def get_enabled(cls, xid):
+        reply = Translator.display.xinput_get_device_property(cls.check(xid),
+            cls.atom("Device Enabled"), X.AnyPropertyType, 0, 1)
+        return ord(reply.value[1][0])
+
+    @classmethod
+    def set_enabled(cls, xid, state):
+        Translator.display.xinput_change_device_property(cls.check(xid),
+            cls.atom("Device Enabled"), Xatom.INTEGER, X.PropModeReplace, (8, [int(state)]))
+        Translator.display.sync()
+
+class KeyRecord(object):
+    """key event handed to the matcher; has scancode and keystate, as KeyEvent"""
+    __slots__ = ["scancode", "keystate", "sec", "usec"]
+
+    def __init__(self, scancode, keystate, sec=0, usec=0):
+        self.scancode = scancode
+        self.keystate = keystate
+        self.sec = sec
+        self.usec = usec
+
+    def timestamp(self):
+        return self.sec + self.usec / 1000000.0
+
+class EventReader(object):
+    """
+    Reads struct input_event of device in bulk into a preallocated buffer
+    and decodes only EV_KEY ones, without autorepeat, to KeyRecord.
+    Events beyond `count` stay in the kernel till next read.
+
+    When kernel buffer overflows (SYN_DROPPED), events up to next SYN_REPORT
+    are skipped, pressed keys are asked from device by `keys` (EVIOCGKEY),
+    and `dropped` is returned, followed by releases of keys released meanwhile.
+    """
+    # struct input_event: struct timeval, __u16 type, __u16 code, __s32 value
+    event = Struct("llHHi")
+    key_hold = 2
+    dropped = KeyRecord(None, None)
+
+    def __init__(self, fd, keys, count=64):
+        self.file = FileIO(fd, "r", closefd=False)
+        self.buffer = bytearray(self.event.size * count)
+        self.keys = keys
+        self.pressed = set(keys())
+        self.dropping = False
+        self.drops = 0
+
+    def read(self):
+        size = self.file.readinto(self.buffer) or 0
+        records = []
+        for offset in xrange(0, size, self.event.size):
+            sec, usec, type, code, value = self.event.unpack_from(self.buffer, offset)
+            if type == ecodes.EV_KEY:
+                if self.dropping or value == self.key_hold:
+                    continue
+                if value:
+                    self.pressed.add(code)
+                else:
+                    self.pressed.discard(code)
+                records.append(KeyRecord(code, value, sec, usec))
+            elif type == ecodes.EV_SYN:
+                if code == ecodes.SYN_DROPPED:
+                    self.dropping = True
+                elif code == ecodes.SYN_REPORT and self.dropping:
+                    self.dropping = False
+                    records += self.resync(sec, usec)
+        return records
+
+    def resync(self, sec, usec):
+        self.drops += 1
+        pressed = set(self.keys())
+        released = [KeyRecord(code, 0, sec, usec) for code in sorted(self.pressed - pressed)]
+        self.pressed = pressed
+        return [self.dropped] + released
+
 class Device(object):
-    def __init__(self, xid=None, name=None, path=None, default_state=None):
+    """
+    Input device read by the processor. Its state (on or off) is "Device Enabled"
+    property in X, or, with `grab`, whether it is grabbed with EVIOCGRAB,
+    which needs no X and hides keys from every other reader.
+    """
+    # _IOW('E', 0x93, struct input_mask)
+    EVIOCSMASK = 0x40104593
+    # struct input_mask: __u32 type, __u32 codes_size, __u64 codes_ptr
+    input_mask = Struct("IIQ")
+
+    def __init__(self, xid=None, name=None, path=None, default_state=None, grab=False):
+        self.xid = None
+        self.initial_state = None
+        self.exclusive = switch(grab)
+        self.grabbed = False
         try:
             if path:
                 self.from_path(path)
@@ -19,55 +182,103 @@ class Device(object):
             else:
                 self.from_name(name)
             self.listener = InputDevice(self.path)
+            self.reader = EventReader(self.listener.fd, self.listener.active_keys)
         except OSError as e:
             raise DeviceError(e)
+        self.mask_events()
         #except IndexError:
         #    logging.critical("Error opening device: not root")
         #    raise DeviceError
-        self.initial_state = self.get_state()
         if default_state is not None:
             self.set_state(default_state or 0)
 
     def from_name(self, device_name):
-        info = Popen(["xinput", "list", "--short", device_name], stdout=PIPE).communicate()[0]
-        try:
-            device_name, self.xid = search(r"^([a-zA-Z0-9 _]+?)\s*id=(\d+)", info).groups(0)
-            path_info = Popen(["xinput", "list-props", self.xid], stdout=PIPE).communicate()[0]
-            self.path = search(r'Device Node \(\d*\):\s*"([a-zA-Z0-9_/]*)"', path_info).group(1)
-        except AttributeError:
-            path = [dev.fn for dev in map(InputDevice, list_devices()) if dev.name==device_name]
-            if not path:
-                raise DeviceError("No device with name %s" % device_name)
-            if len(path) > 1:
-                raise DeviceError("Multiple devices with name %s, use xid or path instead,"
+        uses = None
+        for prefix in XInput.uses:
+            if device_name.startswith(prefix + ":"):
+                device_name = device_name[len(prefix) + 1:]
+                uses = XInput.uses[prefix]
+        found = []
+        if XInput.available():
+            found = [(device.path, device.xid) for device in XInput.find(name=device_name, uses=uses)
+                     if device.path]
+        if not found:
+            # no X, or device is not given to X, e.g. one read in grab mode only
+            found = [(dev.fn, None) for dev in map(InputDevice, list_devices())
+                     if dev.name == device_name]
+        if not found:
+            raise DeviceError("No device with name %s" % device_name)
+        if len(found) > 1:
+            raise DeviceError("Multiple devices with name %s, use xid or path instead,"
                               "or prefix name with 'keyboard' or 'pointer':" % device_name)
+        self.path, self.xid = found[0]
 
     def from_xid(self, xid):
-        self.xid = str(xid)
-        info = Popen(["xinput", "list-props", self.xid], stdout=PIPE).communicate()[0]
-        try:
-            self.path = search(r'Device Node \(\d*\):\s*"([a-zA-Z0-9_/]*)"', info).group(1)
-        except AttributeError:
-            raise DeviceError("No device with id %s" % self.xid)
+        if not XInput.available():
+            raise DeviceError("No X server to look up device with id %s" % xid)
+        self.xid = XInput.check(xid)
+        self.path = XInput.find(xid=self.xid)[0].path
+        if not self.path:
+            raise DeviceError("Device with id %s has no device node" % xid)
 
     def from_path(self, path):
+        # X is asked for xid only when it is needed, see xid
         self.path = path
-        devices = Popen(["xinput"], stdout=PIPE).communicate()[0]
-        xids = findall(r"\b%s\s*id=(\d*)" % InputDevice(path).name, devices)
-        info = Popen(["xinput","list-props"] + xids, stdout=PIPE).communicate()[0]
-        nodes = findall(r'Device Node \(\d*\):\s*"([a-zA-Z0-9_/]*)"', info)
-        print info
-        self.xid = xids[nodes.index(path)]
+        self.resolved = False
+
+    @property
+    def xid(self):
+        if not self.resolved:
+            self.resolved = True
+            found = XInput.available() and XInput.find(path=self.path)
+            self._xid = found[0].xid if found else None
+        return self._xid
+
+    @xid.setter
+    def xid(self, xid):
+        self._xid = xid
+        self.resolved = True
+
+    def mask_events(self):
+        """asks kernel to wake us up for key events only, Linux 4.4+"""
+        types = array("B", [0] * (ecodes.EV_CNT / 8))
+        types[ecodes.EV_KEY / 8] |= 1 << ecodes.EV_KEY % 8
+        # type 0 masks event types, not codes
+        mask = self.input_mask.pack(0, len(types), types.buffer_info()[0])
+        try:
+            ioctl(self.listener.fd, self.EVIOCSMASK, mask)
+        except IOError as e:
+            logging.info("events of %s are not masked by kernel: %s", self.path, e)
+
+    def set_grabbed(self, grabbed):
+        if grabbed == self.grabbed:
+            return
+        try:
+            if grabbed:
+                self.listener.grab()
+            else:
+                self.listener.ungrab()
+        except IOError as e:
+            raise DeviceError("Can not grab %s: %s" % (self.path, e))
+        self.grabbed = grabbed
 
     def set_state(self, state):
-        check_call(["xinput", "set-int-prop", str(self.xid),
-                    "Device Enabled", "8", str(int(state))])
+        if self.initial_state is None:
+            self.initial_state = self.get_state()
+        if self.exclusive:
+            self.set_grabbed(not int(state))
+            return
+        if self.xid is None:
+            logging.warning("device %s is not known to X, state is not changed", self.path)
+            return
+        XInput.set_enabled(self.xid, state)
 
     def get_state(self):
-        output = Popen(["xinput", "list-props", str(self.xid)],
-            stdout=PIPE).communicate()[0]
-        result = search(r'Device Enabled.*(\d)\n', output).group(1)
-        return int(result)
+        if self.exclusive:
+            return int(not self.grabbed)
+        if self.xid is None:
+            return 1
+        return XInput.get_enabled(self.xid)
 
     def toggle(self):
         state = self.get_state()
@@ -77,4 +288,5 @@ class Device(object):
             self.set_state(1)
 
     def exit(self):
-        self.set_state(self.initial_state)
+        if self.initial_state is not None:
+            self.set_state(self.initial_state)
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
-from re import match
-from Xlib import XK
+from re import compile as compile_re
+from Xlib import X, XK
 from Xlib.display import Display
 from evdev import KeyEvent, ecodes
 
@@ -12,27 +12,30 @@ class Expression():
     state_partial = 2
     wildchar = 28
     pattern = ""
-    grammar = {
-        "literal": [["button"], ["wild"]],
-        "button": [["[0-9a-zA-Z]"], ["<[0-9a-zA-Z_]*>"]],
-        "sequence": [["literal", "sequence"], ["literal"]],
-        "wild": [["[*]"]]
-    }
+    # pattern is a sequence of literals: button "a" or "<ENTER>", wild "*",
+    # chord "[ab]" of keys held together, gesture "a~" or "a~800" of key held
+    # for hold_time or 800 ms, or "a^2" of key tapped twice
+    token = compile_re(r"(?P<button>[0-9a-zA-Z]|<[0-9a-zA-Z_]*>)|(?P<wild>\*)"
+                       r"|(?P<open>\[)|(?P<close>\])|(?P<modifier>~[0-9]*|\^[0-9]+)")
+    # most patterns are buttons and wilds only, split at once
+    plain = compile_re(r"(?:[0-9a-zA-Z]|<[0-9a-zA-Z_]*>|\*)*\Z")
+    plain_token = compile_re(r"[0-9a-zA-Z]|<[0-9a-zA-Z_]*>|\*")
 
-    @classmethod
-    def set_wildchar(cls, wildchar):
-        cls.wildchar = Translator.char_to_code(wildchar.strip("<>"))
-
-    def __init__(self, pattern = "", wildchar = "<ENTER>"):
+    def __init__(self, pattern = "", wildchar = "<ENTER>", tokens=None):
+        """tokens of the pattern, if known, save parsing it"""
         self.pattern = pattern
-        self.set_wildchar(wildchar)
-        if pattern:
-            parsed, extra = self.parse(pattern)
-            if extra:
-                raise ValueError("Not valid pattern: %s" % pattern)
-            self.compiled = self.compile(parsed)
+        # code of the key ending wildcard input of this expression
+        self.wildchar = Translator.char_to_code(wildchar.strip("<>"))
+        if pattern and tokens is not None:
+            self.compiled = self.compile_later
+            self.tokens = tokens
+        elif pattern:
+            # patterns are compiled to closures only if Expression.process is used
+            self.compiled = self.compile_later
+            self.tokens = self.tokenize(pattern)
         else:
             self.compiled = lambda x: self.state_reject, [], []
+            self.tokens = []
 
     def __call__(self, keys):
         return self.process(keys)
@@ -40,30 +43,69 @@ class Expression():
     def __str__(self):
         return self.pattern
 
+    def start(self):
+        return ExpressionState(self)
+
     def process(self, keys):
         state, extra, extracted = self.compiled(keys)
         reply = ["".join(Translator.code_to_char(key.scancode) for key in reply_) for reply_ in extracted]
         return self.state_reject if len(extra) else state, reply
 
-    def parse_seq(self, seq, text):
-        result = []
-        for atom in seq:
-            tree, text = self.parse(text, atom)
-            if text is None:
-                return None, None
-            result.append(tree)
-        return result, text
-
-    def parse(self, text, atom="sequence"):
-        if atom in self.grammar:
-            for variant in self.grammar[atom]:
-                tree, rem = self.parse_seq(variant, text)
-                if rem is not None:
-                    return [atom] + tree, rem
+    def tokenize(self, text):
+        """pattern -> flat list of ("button", code) and ("wild", end_code)"""
+        if self.plain.match(text):
+            wild, code = ("wild", self.wildchar), Translator.char_to_code
+            return [wild if name == "*" else ("button", code(name.strip("<>")))
+                    for name in self.plain_token.findall(text)]
+        return [("wild", self.wildchar) if node[0] == "wild" else ("button", self.code(node))
+                for node in self.literals(text)]
+
+    def literals(self, text):
+        """pattern -> list of literal nodes of parse tree, in one pass without recursion"""
+        literals = []
+        chord = None
+        position, end = 0, len(text)
+        while position < end:
+            m = self.token.match(text, position)
+            kind = m and m.lastgroup
+            if kind is None or (chord is not None and kind != "button" and kind != "close") \
+                    or (kind == "close" and chord is None) \
+                    or (kind == "modifier" and (not literals or literals[-1][0] != "button")):
+                raise ValueError("Not valid pattern %s: unexpected %r at position %d"
+                                 % (text, text[position], position))
+            value = m.group()
+            position = m.end()
+            if chord is not None:
+                if kind == "button":
+                    chord.append(["button", value])
+                    continue
+                if not chord:
+                    raise ValueError("Not valid pattern %s: empty chord at position %d"
+                                     % (text, position - 1))
+                keys = ["chord_keys", chord.pop()]
+                while chord:
+                    keys = ["chord_keys", chord.pop(), keys]
+                literals.append(["chord", "[", keys, "]"])
+                chord = None
+            elif kind == "open":
+                chord = []
+            elif kind == "modifier":
+                literals[-1] = ["gesture", literals[-1], value]
+            else:
+                literals.append([kind, value])
+        if chord is not None:
+            raise ValueError("Not valid pattern %s: chord is not closed" % text)
+        return literals
+
+    def parse(self, text):
+        """pattern -> (parse tree, rest of text), as nested "sequence" nodes"""
+        literals = self.literals(text)
+        if not literals:
             return None, None
-        else:
-            m = match(atom, text)
-            return (None, None) if (not m) else (m.group(0), text[m.end():])
+        tree = ["sequence", ["literal", literals.pop()]]
+        while literals:
+            tree = ["sequence", ["literal", literals.pop()], tree]
+        return tree, ""
 
     def button(self, scancode, keystate=KeyEvent.key_down):
         def f(keys):
@@ -104,23 +146,274 @@ class Expression():
             return self.state_partial, [], []
         return f
 
+    def code(self, parsed):
+        """
+        key code of button; chords and gestures get tuple codes, which
+        are sent to the matcher as keys by pybd.gesture.Gestures
+        """
+        name, params = parsed[0], parsed[1:]
+        if name == "button":
+            return Translator.char_to_code(params[0].strip("<>"))
+        elif name == "chord":
+            codes = set()
+            keys = params[1]
+            while keys:
+                codes.add(self.code(keys[1]))
+                keys = keys[2] if len(keys) > 2 else None
+            if len(codes) < 2:
+                raise ValueError("Chord of less than two keys: %s" % self.pattern)
+            return ("chord", tuple(sorted(codes)))
+        elif name == "gesture":
+            key, modifier = self.code(params[0]), params[1]
+            if modifier[0] == "~":
+                # 0 is hold_time of processor
+                return ("hold", key, int(modifier[1:] or 0))
+            if int(modifier[1:]) < 2:
+                raise ValueError("Less than two taps: %s" % self.pattern)
+            return ("tap", key, int(modifier[1:]))
+        raise ValueError("No such method: %s" % name)
+
     def compile(self, parsed):
         name, params = parsed[0], parsed[1:]
-        if name is "literal":
+        if name == "literal":
             return self.compile(params[0])
-        elif name is "button":
-            code = Translator.char_to_code(params[0].strip("<>"))
-            return self.button(code)
-        elif name is "wild":
+        elif name in ("button", "chord", "gesture"):
+            return self.button(self.code(parsed))
+        elif name == "wild":
             return self.wild(self.wildchar)
-        elif name is "sequence":
-            return self.sequence(*[self.compile(param) for param in params])
+        elif name == "sequence":
+            # same results as nested sequences of the tree, which reply only
+            # with the first literal's keys on reject, but just two levels deep
+            literals = [self.compile(literal) for literal in self.spine(parsed)]
+            if len(literals) == 1:
+                return self.sequence(literals[0])
+            return self.sequence(literals[0], self.sequence(*literals[1:]))
         raise ValueError("No such method: %s" % name)
 
+    def spine(self, parsed):
+        """literals of nested "sequence" nodes, walked without recursion"""
+        literals = []
+        while parsed:
+            literals.append(parsed[1])
+            parsed = parsed[2] if len(parsed) > 2 else None
+        return literals
+
+    def compile_later(self, keys):
+        # only Expression.process needs the parse tree, it is built on first call
+        self.compiled = self.compile(self.parse(self.pattern)[0])
+        return self.compiled(keys)
+
+
+class ExpressionState(object):
+    """
+    Resumable match of a single expression, advanced with one key at a time.
+    Unlike Expression.process it never looks at previous keys again.
+    """
+    __slots__ = ["tokens", "position", "captured", "extracted", "state"]
+
+    def __init__(self, expression):
+        self.tokens = expression.tokens
+        self.position = 0
+        self.captured = None
+        self.extracted = []
+        self.state = Expression.state_partial if self.tokens else Expression.state_reject
+        self.enter()
+
+    def enter(self):
+        if self.position == len(self.tokens):
+            self.state = Expression.state_accept
+        elif self.tokens[self.position][0] == "wild":
+            self.captured = []
+
+    def advance(self, key):
+        if self.state is not Expression.state_partial:
+            # any key after the end of expression spoils it
+            self.state = Expression.state_reject
+            return self.state
+        if key.keystate != KeyEvent.key_down:
+            return self.state
+        kind, code = self.tokens[self.position]
+        if kind == "button":
+            if key.scancode != code:
+                self.state = Expression.state_reject
+                return self.state
+        elif key.scancode != code:
+            self.captured.append(key.scancode)
+            return self.state
+        else:
+            self.extracted.append(self.captured)
+        self.position += 1
+        self.enter()
+        return self.state
+
+    def reply(self):
+        return ["".join(Translator.code_to_char(code) for code in reply_)
+                for reply_ in self.extracted]
+
+
+class GestureIndex(object):
+    """chord and gesture codes of a namespace, by key, see pybd.gesture"""
+
+    def __init__(self):
+        self.chords = set()
+        # chords that are part of bigger ones, they wait for the key release
+        self.partial_chords = set()
+        self.chord_keys = set()
+        # key -> sorted thresholds, in ms
+        self.holds = {}
+        # key -> tap counts
+        self.taps = {}
+
+    def __nonzero__(self):
+        return bool(self.chords or self.holds or self.taps)
+
+    def add(self, code):
+        if code[0] == "chord" and code[1] not in self.chords:
+            keys = set(code[1])
+            for chord in self.chords:
+                if keys < set(chord):
+                    self.partial_chords.add(code[1])
+                elif keys > set(chord):
+                    self.partial_chords.add(chord)
+            self.chords.add(code[1])
+            self.chord_keys.update(keys)
+        elif code[0] == "hold":
+            self.holds[code[1]] = sorted(set(self.holds.get(code[1], []) + [code[2]]))
+        elif code[0] == "tap":
+            self.taps.setdefault(code[1], set()).add(code[2])
+
+
+class MatcherNode(object):
+    __slots__ = ["children", "wilds", "accept"]
+
+    def __init__(self):
+        self.children = {}
+        self.wilds = {}
+        self.accept = None
+
+
+class Matcher(object):
+    """
+    Prefix tree built from tokens of all expressions of a namespace.
+    It is stepped once per key, so cost of a key press does not depend
+    on the number of bindings. When several expressions accept on the same
+    key, the first one added wins, as with looping over expressions in order.
+    """
+
+    def __init__(self, bindings=(), tables=None):
+        """tables of the tree of these bindings, if known, save building it"""
+        self.root = MatcherNode()
+        self.bindings = []
+        self.gestures = GestureIndex()
+        if tables:
+            self.bindings = list(bindings)
+            self.load(tables)
+        else:
+            for expression, handler in bindings:
+                self.add(expression, handler)
+        self.reset()
+
+    def add(self, expression, handler):
+        node = self.root
+        for kind, code in expression.tokens:
+            if isinstance(code, tuple):
+                self.gestures.add(code)
+            edges = node.children if kind == "button" else node.wilds
+            node = edges.setdefault(code, MatcherNode())
+        if node.accept is None and node is not self.root:
+            node.accept = len(self.bindings)
+        self.bindings.append((expression, handler))
+
+    def tables(self):
+        """tree as flat lists by node number, root being 0: children, wilds and accepts"""
+        nodes, children, wilds, accepts = [self.root], [], [], []
+        # nodes are numbered as they are reached, list grows while walked over
+        for node in nodes:
+            for edges, table in ((node.children, children), (node.wilds, wilds)):
+                table.append(dict((code, len(nodes) + i) for i, code in enumerate(edges)))
+                nodes.extend(edges.values())
+            accepts.append(node.accept)
+        return children, wilds, accepts
+
+    def load(self, tables):
+        children, wilds, accepts = tables
+        nodes = [MatcherNode() for accept in accepts]
+        for node, node_children, node_wilds, accept in zip(nodes, children, wilds, accepts):
+            node.children = dict((code, nodes[number]) for code, number in node_children.items())
+            node.wilds = dict((code, nodes[number]) for code, number in node_wilds.items())
+            node.accept = accept
+            for code in node_children:
+                if isinstance(code, tuple):
+                    self.gestures.add(code)
+        self.root = nodes[0]
+
+    def fork(self):
+        """matcher sharing the tree of this one, but with its own state"""
+        matcher = Matcher()
+        matcher.root = self.root
+        matcher.bindings = self.bindings
+        matcher.gestures = self.gestures
+        matcher.reset()
+        return matcher
+
+    def reset(self):
+        # thread: (node, wild end code or None, captured wild input, extracted)
+        self.threads = [(self.root, None, None, ())]
+
+    def step(self, key):
+        if key.keystate != KeyEvent.key_down:
+            return Expression.state_partial, None, []
+        code = key.scancode
+        threads = []
+        best = [None, None]
+
+        def arrive(node, extracted):
+            if node.accept is not None and (best[0] is None or node.accept < best[0]):
+                best[:] = node.accept, extracted
+            if node.children or node.wilds:
+                threads.append((node, None, None, extracted))
+
+        for node, end, captured, extracted in self.threads:
+            if end is not None:
+                if code == end:
+                    arrive(node.wilds[end], extracted + (captured,))
+                else:
+                    captured.append(code)
+                    threads.append((node, end, captured, extracted))
+                continue
+            if code in node.children:
+                arrive(node.children[code], extracted)
+            for end in node.wilds:
+                if code == end:
+                    arrive(node.wilds[end], extracted + ([],))
+                else:
+                    threads.append((node, end, [code], extracted))
+
+        if best[0] is not None:
+            self.reset()
+            # chords and gestures are not text
+            reply = ["".join(Translator.code_to_char(code_) for code_ in reply_
+                             if not isinstance(code_, tuple))
+                     for reply_ in best[1]]
+            return Expression.state_accept, self.bindings[best[0]], reply
+        if not threads:
+            self.reset()
+            return Expression.state_reject, None, []
+        self.threads = threads
+        return Expression.state_partial, None, []
+
 
 class Translator(object):
     device = "key"
     display = None
+    # code -> name, per device type
+    names = {}
+    # (device type, name) -> code
+    codes = {}
+    # code -> char, per modifiers; built from X keymap, see refresh
+    chars = {}
+    # called with the display, when X connection is opened
+    display_hooks = []
 
     @classmethod
     def set_device_type(cls, device="key"):
@@ -128,24 +421,81 @@ class Translator(object):
 
     @classmethod
     def char_to_code(cls, char):
-        template = {"key": "KEY_%s", "button": "BTN_%s"}[cls.device]
-        return ecodes.ecodes.get(template % char.upper(), None)
+        try:
+            return cls.codes[cls.device, char]
+        except KeyError:
+            template = {"key": "KEY_%s", "button": "BTN_%s"}[cls.device]
+            code = cls.codes[cls.device, char] = ecodes.ecodes.get(template % char.upper(), None)
+            return code
 
     @classmethod
     def code_to_char(cls, code, modifiers=0):
         if cls.device is "button":
             return "<%s>" % cls.key_to_name(code)
-        if not cls.display:
-            cls.display = Display()
-        return XK.keysym_to_string(cls.display.keycode_to_keysym(code + 8, modifiers))
+        return cls.char_table(modifiers).get(code, None)
 
     @classmethod
     def key_to_name(cls, key):
         try:
             name = key.keycode[4:].lower()
         except AttributeError:
+            code = getattr(key, "scancode", key)
+            if isinstance(code, tuple):
+                return cls.gesture_name(code)
+            name = cls.name_table()[code]
+        return name
+
+    @classmethod
+    def gesture_name(cls, code):
+        if code[0] == "chord":
+            return "[%s]" % "".join("<%s>" % cls.key_to_name(key) for key in code[1])
+        return "<%s>%s%d" % (cls.key_to_name(code[1]), "~" if code[0] == "hold" else "^", code[2])
+
+    @classmethod
+    def open_display(cls):
+        if not cls.display:
+            cls.display = Display()
+            for hook in cls.display_hooks:
+                hook(cls.display)
+        return cls.display
+
+    @classmethod
+    def char_table(cls, modifiers=0):
+        table = cls.chars.get(modifiers, None)
+        if table is None:
+            cls.open_display()
+            info = cls.display.display.info
+            table = {}
+            for keycode in range(info.min_keycode, info.max_keycode + 1):
+                keysym = cls.display.keycode_to_keysym(keycode, modifiers)
+                table[keycode - 8] = XK.keysym_to_string(keysym)
+            cls.chars[modifiers] = table
+        return table
+
+    @classmethod
+    def name_table(cls):
+        table = cls.names.get(cls.device, None)
+        if table is None:
             prefix = {"key": "KEY_", "button": "BTN_"}[cls.device]
-            keys = [(key_[4:],code) for key_, code in ecodes.ecodes.items()
-                                    if key_.startswith(prefix)]
-            name = sorted(filter(lambda (k,v): v==key, keys), key=lambda (x,y): len(x))[0][0]
-        return name
\ No newline at end of file
+            table = {}
+            for name, code in ecodes.ecodes.items():
+                # shortest of aliases, like BTN_0 for BTN_MISC
+                if name.startswith(prefix) and len(name) - 4 < len(table.get(code, name)):
+                    table[code] = name[4:]
+            cls.names[cls.device] = table
+        return table
+
+    @classmethod
+    def refresh(cls, event=None):
+        """drops keymap tables, so they are rebuilt on next translation"""
+        if event is not None and cls.display:
+            cls.display.refresh_keyboard_mapping(event)
+        cls.chars = {}
+
+    @classmethod
+    def handle_x_events(cls):
+        # MappingNotify is sent to every client, no need to select it
+        while cls.display.pending_events():
+            event = cls.display.next_event()
+            if event.type == X.MappingNotify:
+                cls.refresh(event)
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+from pybd.device import KeyRecord
+
+__author__ = 'iljich'
+
+class KeyTimers(object):
+    __slots__ = ["holds", "held", "taps", "window"]
+
+    def __init__(self):
+        self.holds = []
+        self.held = False
+        self.taps = 0
+        self.window = None
+
+
+class Gestures(object):
+    """
+    Turns key events of a session into chords, long presses and taps
+    (see GestureIndex), passed to `session.emit` as keys with tuple codes.
+    Keys used by them are held back until it is clear what they are:
+    a key of chords till chord is complete or some key is released, a key
+    with long presses till it is released, a key with taps till no tap
+    follows within `tap_window`. Other keys are passed right away, but
+    never before keys held back: these are resolved when other key is
+    pressed, as if they were pressed one by one.
+    Timers run on the processor's wheel, times are in ms.
+    """
+    wheel = None
+    hold_time = 500
+    tap_window = 300
+
+    def __init__(self, index, session):
+        self.index = index
+        self.session = session
+        # keys of chords being pressed, in order
+        self.pressed = []
+        self.chord = None
+        self.chord_done = False
+        # key -> KeyTimers
+        self.keys = {}
+
+    def feed(self, record):
+        code = record.scancode
+        if record.keystate == 1:
+            self.resolve(code, record)
+        if code in self.index.chord_keys:
+            self.feed_chord(record)
+        elif code in self.index.holds or code in self.index.taps:
+            self.feed_timed(record)
+        else:
+            self.session.emit(record)
+
+    def close(self):
+        for timers in self.keys.values():
+            for timer in timers.holds + [timers.window]:
+                if timer:
+                    self.wheel.cancel(timer)
+        self.keys = {}
+
+    def resolve(self, code, record):
+        """passes keys held back, but other than `code`, as they are now"""
+        if self.pressed and not self.chord_done and code not in self.index.chord_keys:
+            self.finish_chord(record)
+        for key, timers in self.keys.items():
+            if key == code:
+                continue
+            if timers.holds:
+                for timer in timers.holds:
+                    self.wheel.cancel(timer)
+                timers.holds = []
+                # key is still down, its release is ignored like after long press
+                timers.held = True
+                for i in range(timers.taps + 1):
+                    self.press(key, record.sec, record.usec)
+                timers.taps = 0
+            elif timers.window:
+                self.wheel.cancel(timers.window)
+                self.tapped(key, record.timestamp())
+
+    def press(self, code, sec, usec):
+        self.session.emit(KeyRecord(code, 1, sec, usec))
+        self.session.emit(KeyRecord(code, 0, sec, usec))
+
+    def press_at(self, code, when):
+        self.press(code, int(when), int(when % 1 * 1000000))
+
+    def feed_chord(self, record):
+        code = record.scancode
+        if record.keystate:
+            self.pressed.append(code)
+            if self.chord_done:
+                return
+            keys = tuple(sorted(set(self.pressed)))
+            if keys in self.index.chords:
+                self.chord = keys
+                if keys not in self.index.partial_chords:
+                    self.finish_chord(record)
+            return
+        if code not in self.pressed:
+            return
+        if not self.chord_done:
+            self.finish_chord(record)
+        self.pressed = [key for key in self.pressed if key != code]
+        if not self.pressed:
+            self.chord, self.chord_done = None, False
+
+    def finish_chord(self, record):
+        # no chord - keys were pressed one by one
+        self.chord_done = True
+        if self.chord:
+            self.press(("chord", self.chord), record.sec, record.usec)
+        else:
+            for code in self.pressed:
+                self.press(code, record.sec, record.usec)
+
+    def feed_timed(self, record):
+        code = record.scancode
+        timers = self.keys.get(code)
+        if timers is None:
+            timers = self.keys[code] = KeyTimers()
+        if record.keystate:
+            if timers.window:
+                self.wheel.cancel(timers.window)
+                timers.window = None
+            timers.held = False
+            start = record.timestamp()
+            timers.holds = [self.wheel.schedule(start + (ms or self.hold_time) / 1000.0,
+                                                lambda when, ms=ms: self.held(code, ms, when))
+                            for ms in self.index.holds.get(code, [])]
+            return
+        for timer in timers.holds:
+            self.wheel.cancel(timer)
+        timers.holds = []
+        if timers.held:
+            return
+        timers.taps += 1
+        counts = self.index.taps.get(code)
+        if not counts:
+            self.press(code, record.sec, record.usec)
+            timers.taps = 0
+        elif timers.taps >= max(counts):
+            self.tapped(code, record.timestamp())
+        else:
+            timers.window = self.wheel.schedule(record.timestamp() + self.tap_window / 1000.0,
+                                                lambda when: self.tapped(code, when))
+
+    def held(self, code, ms, when):
+        timers = self.keys[code]
+        if not timers.held:
+            # taps before the long press are just presses
+            for i in range(timers.taps):
+                self.press_at(code, when)
+            timers.taps = 0
+        timers.held = True
+        self.press_at(("hold", code, ms), when)
+
+    def tapped(self, code, when):
+        timers = self.keys[code]
+        count, timers.taps, timers.window = timers.taps, 0, None
+        if count in self.index.taps[code] and count > 1:
+            self.press_at(("tap", code, count), when)
+        else:
+            for i in range(count):
+                self.press_at(code, when)
@@ -1,15 +1,34 @@
 # -*- coding: utf-8 -*-
+from collections import deque
+from errno import EAGAIN, ENXIO, EPIPE
 from imp import load_source
-from os.path import dirname, isabs, join
-from subprocess import call
+from json import dumps, loads
+import os
+from os import getuid, O_APPEND, O_CREAT, O_NONBLOCK, O_WRONLY, SEEK_SET
+from os.path import dirname, getmtime, isabs, join
+from pwd import getpwuid
+from re import match
+from signal import SIGKILL
+from stat import S_ISREG
+from string import Formatter
+from subprocess import PIPE, Popen
+from sys import executable
+from threading import Event, Lock, Thread
 
 __author__ = 'iljich'
 
+class HandlerTimeout(Exception):
+    pass
+
 class HandlerFactory(object):
     products = {}
+    # makes every handler a dummy one, e.g. for replays
+    stubbed = False
 
     def __init__(self, product_name, params):
-        self.product = self.products[product_name]
+        # switching namespaces has no side effects, so it is not stubbed
+        stubbed = self.stubbed and product_name != "namespace"
+        self.product = self.products["dummy" if stubbed else product_name]
         self.params = params
 
     def __call__(self, cmd):
@@ -21,22 +40,139 @@ class HandlerFactory(object):
 
 def handler(name):
     def inner(cls):
+        cls.product_name = name
         HandlerFactory.register(name, cls)
         return cls
     return inner
 
+class Limiter(object):
+    """
+    Keeps triggers of a handler `debounce` seconds apart and at most `count`
+    per `period` seconds. Trigger over the limits is dropped, or with
+    policy "queue" run when limits allow (up to `queue_size` waiting), or
+    with policy "last" replaces the one waiting. Runs on processor's wheel,
+    times are those of key events.
+    """
+    wheel = None
+    policies = ("drop", "queue", "last")
+    queue_size = 64
+
+    def __init__(self, debounce=0, count=0, period=1, policy="drop"):
+        if policy not in self.policies:
+            raise ValueError("policy is one of %s, not %s" % (", ".join(self.policies), policy))
+        self.debounce = debounce
+        self.count = count
+        self.period = period
+        self.policy = policy
+        # run times within last period, or just the last one for debounce
+        self.runs = deque() if count else deque(maxlen=1)
+        self.waiting = deque()
+        self.timer = None
+
+    def delay(self, now):
+        """seconds till next run is allowed"""
+        delay = 0
+        if self.debounce and self.runs:
+            delay = self.runs[-1] + self.debounce - now
+        if self.count:
+            while self.runs and self.runs[0] <= now - self.period:
+                self.runs.popleft()
+            if len(self.runs) >= self.count:
+                delay = max(delay, self.runs[0] + self.period - now)
+        return delay
+
+    def submit(self, now, run):
+        """runs or delays `run` callable; returns what was done if not run"""
+        if self.timer is None:
+            delay = self.delay(now)
+            if delay <= 0:
+                self.runs.append(now)
+                run()
+                return None
+            if self.policy == "drop":
+                return "dropped"
+            self.waiting.append(run)
+            self.timer = self.wheel.schedule(now + delay, self.release)
+            return "delayed"
+        if self.policy == "last":
+            self.waiting[0] = run
+            return "replaced"
+        if self.policy == "queue" and len(self.waiting) < self.queue_size:
+            self.waiting.append(run)
+            return "delayed"
+        return "dropped"
+
+    def release(self, when):
+        self.timer = None
+        self.runs.append(when)
+        self.waiting.popleft()()
+        if self.waiting:
+            self.timer = self.wheel.schedule(when + max(self.delay(when), 0), self.release)
+
+    def close(self):
+        if self.timer:
+            self.wheel.cancel(self.timer)
+            self.timer = None
+        self.waiting.clear()
+
+
+def seconds(value, unit="ms"):
+    """ "50ms", "0.05s", "1m", "1h" or a number of `unit`s to seconds"""
+    scales = (("ms", 0.001), ("s", 1), ("m", 60), ("h", 3600))
+    value = value.strip()
+    for suffix, scale in scales:
+        if value.endswith(suffix):
+            return float(value[:-len(suffix)]) * scale
+    return float(value) * dict(scales)[unit]
+
+
 class AbstractHandler(object):
     params = {}
     def __init__(self, cmd, params):
         self.cmd = cmd
-        self.params.update(params)
+        self.params = dict(self.params, **params)
+        self.limiter = self.limits()
 
     def apply(self, params):
         return self.cmd.format(*params)
 
+    def placeholders(self):
+        """number of params used by command"""
+        count = 0
+        for text, field, spec, conversion in Formatter().parse(self.cmd):
+            if field is not None:
+                index = match(r"\d*", field).group()
+                count = max(count, int(index) + 1) if index else count + 1
+        return count
+
     def param(self, name):
         return self.params.get(name, None)
 
+    def concurrency(self):
+        return int(self.param("concurrency") or 1)
+
+    def timeout(self):
+        timeout = self.param("timeout")
+        return float(timeout) if timeout else None
+
+    def limits(self):
+        """
+        Limiter of params `debounce` ("50ms", ms by default), `max_rate`
+        ("5/s", "30/m", per second by default) and `policy`, None if unlimited
+        """
+        debounce = self.param("debounce")
+        rate = self.param("max_rate")
+        if not debounce and not rate:
+            return None
+        count, period = 0, 1
+        if rate:
+            count, slash, per = rate.partition("/")
+            count = int(count)
+            if per:
+                period = seconds(per if per[0].isdigit() else "1" + per, "s")
+        return Limiter(seconds(debounce) if debounce else 0, count, period,
+                       self.param("policy") or "drop")
+
     def __call__(self, params):
         pass
 
@@ -47,38 +183,243 @@ class AbstractHandler(object):
 class DummyHandler(AbstractHandler):
     pass
 
+@handler("namespace")
+class NamespaceHandler(AbstractHandler):
+    """
+    Switches device, on which it was triggered, to namespace named by command.
+    It is done by the processor right away, not by the pool.
+    """
+    pass
+
+class ShellWorker(object):
+    """
+    Long-lived helper process (see shellworker.py) running shell commands
+    as a given user, so a trigger costs a line written to its pipe instead
+    of sudo and two shells. Helper that died is started again on next command.
+    """
+    workers = {}
+    lock = Lock()
+    with open(join(dirname(__file__), "shellworker.py")) as f:
+        helper = f.read()
+
+    @classmethod
+    def get(cls, user):
+        with cls.lock:
+            if user not in cls.workers:
+                cls.workers[user] = cls(user)
+            return cls.workers[user]
+
+    @classmethod
+    def stop_all(cls):
+        with cls.lock:
+            for worker in cls.workers.values():
+                worker.stop()
+            cls.workers = {}
+
+    def __init__(self, user):
+        self.user = user
+        self.lock = Lock()
+        self.waiting = {}
+        self.counter = 0
+        self.process = None
+        self.start()
+
+    def start(self):
+        cmd = [executable, "-c", self.helper]
+        if self.user != getpwuid(getuid()).pw_name:
+            cmd = ["sudo", "-u", self.user, "--"] + cmd
+        self.process = Popen(cmd, stdin=PIPE, stdout=PIPE, close_fds=True)
+        reader = Thread(target=self.read, args=(self.process,), name="shell-%s" % self.user)
+        reader.daemon = True
+        reader.start()
+
+    def stop(self):
+        with self.lock:
+            if self.process:
+                self.process.stdin.close()
+                self.process = None
+
+    def read(self, process):
+        for line in iter(process.stdout.readline, ""):
+            reply = loads(line)
+            with self.lock:
+                waiter = self.waiting.pop(reply["id"], None)
+            if waiter:
+                waiter[1] = reply["code"]
+                waiter[0].set()
+        process.wait()
+        with self.lock:
+            if self.process is process:
+                self.process = None
+            # commands of dead helper will never reply
+            for id, waiter in self.waiting.items():
+                if waiter[2] is process:
+                    del self.waiting[id]
+                    waiter[0].set()
+
+    def run(self, cmd, args, timeout=None):
+        """runs `sh -c cmd sh args...`, returns exit code"""
+        with self.lock:
+            if self.process is None:
+                self.start()
+            self.counter += 1
+            waiter = self.waiting[self.counter] = [Event(), None, self.process]
+            request = {"id": self.counter, "cmd": cmd, "args": list(args), "timeout": timeout}
+            try:
+                self.process.stdin.write(dumps(request) + "\n")
+                self.process.stdin.flush()
+            except IOError:
+                del self.waiting[self.counter]
+                self.process = None
+                raise
+        waiter[0].wait()
+        if waiter[1] is None:
+            raise IOError("shell helper of %s died" % self.user)
+        return waiter[1]
+
 @handler("shell")
 class ShellHandler(AbstractHandler):
     params = {"user": "nobody"}
 
+    def __init__(self, cmd, params):
+        super(ShellHandler, self).__init__(cmd, params)
+        # params are passed to sh as "$1", "$2"..., never parsed by it
+        self.count = self.placeholders()
+        self.script = self.apply(['"$%d"' % (i + 1) for i in range(self.count)])
+        self.worker = ShellWorker.get(self.param("user"))
+
     def __call__(self, params):
-        cmd = "sudo -u %s sh -c '%s' > /dev/null" % \
-            (self.param("user"), self.apply(params))
-        call(cmd, shell=True)
+        timeout = self.timeout()
+        code = self.worker.run(self.script, params[:self.count], timeout)
+        if timeout and code == -SIGKILL:
+            raise HandlerTimeout("killed after %s seconds" % timeout)
+
+class Writer(object):
+    """
+    Long-lived non-blocking writer, shared by all handlers with the same
+    path and mode. Data that can not be written right away (full pipe or
+    no reader yet) is kept up to `limit` bytes and written with the next
+    trigger. With `batch` > 1 writes are done every `batch` triggers.
+    In "w" mode regular files are truncated before each write, as before.
+    """
+    writers = {}
+    lock = Lock()
+
+    @classmethod
+    def get(cls, path, mode="w", limit=65536, batch=1):
+        with cls.lock:
+            if (path, mode) not in cls.writers:
+                cls.writers[path, mode] = cls(path, mode, limit, batch)
+            return cls.writers[path, mode]
+
+    @classmethod
+    def close_all(cls):
+        with cls.lock:
+            for writer in cls.writers.values():
+                writer.close()
+            cls.writers = {}
+
+    def __init__(self, path, mode="w", limit=65536, batch=1):
+        self.path = path
+        self.mode = mode
+        self.limit = limit
+        self.batch = batch
+        self.fd = None
+        self.truncate = False
+        self.pending = ""
+        self.queued = 0
+        self.lock = Lock()
+
+    def open(self):
+        flags = O_WRONLY | O_NONBLOCK | O_CREAT | (O_APPEND if "a" in self.mode else 0)
+        self.fd = os.open(self.path, flags, 0666)
+        self.truncate = "w" in self.mode and S_ISREG(os.fstat(self.fd).st_mode)
+
+    def write(self, data):
+        with self.lock:
+            if len(self.pending) + len(data) > self.limit:
+                raise IOError("write buffer of %s is full, data dropped" % self.path)
+            self.pending += data
+            self.queued += 1
+            if self.queued >= self.batch:
+                self.flush()
+
+    def flush(self):
+        try:
+            if self.fd is None:
+                self.open()
+            if self.truncate:
+                os.ftruncate(self.fd, 0)
+                os.lseek(self.fd, 0, SEEK_SET)
+            while self.pending:
+                self.pending = self.pending[os.write(self.fd, self.pending):]
+            self.queued = 0
+        except OSError as e:
+            if e.errno in (ENXIO, EPIPE):
+                # no reader on the other side, data is kept till it is opened again
+                if self.fd is not None:
+                    os.close(self.fd)
+                    self.fd = None
+            elif e.errno != EAGAIN:
+                raise
+
+    def close(self):
+        if self.fd is not None:
+            if self.pending:
+                self.flush()
+            if self.fd is not None:
+                os.close(self.fd)
+            self.fd = None
 
 @handler("pipe")
 class PipeHandler(AbstractHandler):
     params = {
         "path": "/dev/null",
-        "mode": "w"
+        "mode": "w",
+        "buffer": "65536",
+        "batch": "1",
     }
 
+    def __init__(self, cmd, params):
+        super(PipeHandler, self).__init__(cmd, params)
+        self.writer = Writer.get(self.param("path"), self.param("mode"),
+                                 int(self.param("buffer")), int(self.param("batch")))
+
     def __call__(self, params):
-        with open(self.param("path"), self.param("mode")) as pipe:
-            pipe.write(self.apply(params))
+        self.writer.write(self.apply(params))
 
 @handler("callback")
 class CallbackHandler(AbstractHandler):
     params = {"path": "../callbacks/callbacks.py"}
+    # path -> (mtime, module), shared by handlers and kept between reloads
+    modules = {}
 
     def __init__(self, cmd, params):
         super(CallbackHandler, self).__init__(cmd, params)
         path = self.params["path"]
         if not isabs(path):
             path = join(dirname(__file__), path)
-        self.global_scope = load_source("_", path).__dict__
+        self.global_scope = self.load(path).__dict__
+        self.function = self.bind()
+
+    @classmethod
+    def load(cls, path):
+        mtime = getmtime(path)
+        if path not in cls.modules or cls.modules[path][0] != mtime:
+            name = "_callbacks_%d" % len(cls.modules) if path not in cls.modules \
+                else cls.modules[path][1].__name__
+            cls.modules[path] = mtime, load_source(name, path)
+        return cls.modules[path][1]
+
+    def bind(self):
+        """
+        compiles command once into a function of extracted params,
+        e.g. "play({0})" becomes "lambda _0, *_extra: play(_0)",
+        living in the module's own namespace
+        """
+        args = ["_%d" % i for i in range(self.placeholders())]
+        return eval("lambda %s: %s" % (", ".join(args + ["*_extra"]), self.apply(args)),
+                    self.global_scope)
 
     def __call__(self, params):
-        local_scope = {"_%d" % i: params[i] for i in range(len(params))}
-        eval(self.apply(local_scope.keys()),
-            dict(local_scope.items() + self.global_scope.items())) # god save the kitten
+        self.function(*params)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from collections import defaultdict
+from threading import Lock
+
+__author__ = 'iljich'
+
+def labels(**kwargs):
+    """label set in Prometheus syntax, to be formatted once and reused"""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return ",".join('%s="%s"' % (name, escape(value)) for name, value in sorted(kwargs.items()))
+
+class Metrics(object):
+    """
+    Registry of counters, gauges and histograms of the daemon, rendered
+    in Prometheus text format. Counters are plain dict increments, so they
+    are kept on the main loop all the time; histograms may be observed
+    from handler threads and take a lock.
+    """
+    declared = [
+        ("pybd_wakeups_total", "counter", "Main loop wakeups."),
+        ("pybd_events_total", "counter", "Key events read from device."),
+        ("pybd_events_lost_total", "counter", "Times kernel dropped events of device."),
+        ("pybd_buffer_depth", "gauge", "Key events in partial input of device."),
+        ("pybd_keys_total", "counter", "Key events by result of matching."),
+        ("pybd_matches_total", "counter", "Accepted expressions."),
+        ("pybd_handler_limited_total", "counter", "Triggers dropped, delayed or replaced by handler limits."),
+        ("pybd_handler_runs_total", "counter", "Handler runs by outcome, per handler type."),
+        ("pybd_handler_seconds", "histogram", "Handler run time, per handler type."),
+    ]
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = Lock()
+        # name -> labels -> value
+        self.values = defaultdict(lambda: defaultdict(int))
+        # name -> labels -> [count per bucket..., count above all, sum]
+        self.histograms = defaultdict(dict)
+        # name -> function returning {labels: value}
+        self.gauges = {}
+
+    def inc(self, name, labels="", value=1):
+        self.values[name][labels] += value
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            entry = self.histograms[name].get(labels)
+            if entry is None:
+                entry = self.histograms[name][labels] = [0] * (len(self.buckets) + 2)
+            entry[bisect_left(self.buckets, value)] += 1
+            entry[-1] += value
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    def render(self):
+        lines = []
+        for name, kind, help in self.declared:
+            lines += ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, kind)]
+            if kind == "histogram":
+                with self.lock:
+                    histograms = [(labels, list(entry)) for labels, entry in self.histograms[name].items()]
+                for labels, entry in sorted(histograms):
+                    lines += self.render_histogram(name, labels, entry)
+                continue
+            values = self.gauges[name]() if name in self.gauges else dict(self.values[name])
+            for labels, value in sorted(values.items()):
+                lines.append("%s%s %s" % (name, "{%s}" % labels if labels else "", value))
+        return "\n".join(lines) + "\n"
+
+    def render_histogram(self, name, labels, entry):
+        lines = []
+        count = 0
+        prefix = labels + "," if labels else ""
+        for bound, hits in zip(self.buckets + ("+Inf",), entry[:-1]):
+            count += hits
+            lines.append('%s_bucket{%sle="%s"} %d' % (name, prefix, bound, count))
+        lines.append("%s_sum%s %s" % (name, "{%s}" % labels if labels else "", entry[-1]))
+        lines.append("%s_count%s %d" % (name, "{%s}" % labels if labels else "", count))
+        return lines
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+import os
+from daemon.pidlockfile import PIDLockFile
+from lockfile import NotMyLock, NotLocked
+
+__author__ = 'iljich'
+
+class MyPIDLockFile(PIDLockFile):
+
+    def acquire(self, *args, **kwargs):
+        try:
+            self.release()
+        except NotMyLock:
+            if not os.path.exists("/proc/%s" % self.read_pid()):
+                self.break_lock()
+        except NotLocked:
+            pass
+        super(MyPIDLockFile, self).acquire(*args, **kwargs)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from collections import defaultdict, deque
+import logging
+from Queue import Queue
+from threading import Lock, Thread
+from time import time
+from pybd.handler import HandlerTimeout
+from pybd.metrics import labels
+
+__author__ = 'iljich'
+
+class HandlerPool(object):
+    """
+    Bounded pool of worker threads running handlers away from the main loop.
+    Each handler runs at most `handler.concurrency()` times at once, extra
+    triggers wait in its own queue. When `queue_size` triggers are pending,
+    new ones are dropped, so a stuck handler can not eat all the memory.
+    """
+
+    def __init__(self, workers=4, queue_size=64, metrics=None):
+        self.queue_size = queue_size
+        self.metrics = metrics
+        self.jobs = Queue()
+        self.lock = Lock()
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(deque)
+        self.pending = 0
+        self.stats = defaultdict(int)
+        self.workers = [Thread(target=self.work, name="handler-%d" % n)
+                        for n in range(workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, handler, params):
+        with self.lock:
+            if self.pending >= self.queue_size:
+                self.stats["dropped"] += 1
+                logging.warning("handler queue is full, '%s' dropped", handler)
+                return False
+            self.pending += 1
+            self.stats["submitted"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.pending)
+            if self.running[handler] >= handler.concurrency():
+                self.waiting[handler].append(params)
+                return True
+            self.running[handler] += 1
+        self.jobs.put((handler, params))
+        return True
+
+    def depth(self):
+        return self.pending
+
+    def work(self):
+        while True:
+            handler, params = self.jobs.get()
+            while True:
+                start = time()
+                outcome = self.execute(handler, params)
+                if self.metrics:
+                    kind = labels(handler=handler.product_name)
+                    self.metrics.observe("pybd_handler_seconds", kind, time() - start)
+                with self.lock:
+                    self.stats[outcome] += 1
+                    if self.metrics:
+                        self.metrics.inc("pybd_handler_runs_total", kind + ',outcome="%s"' % outcome)
+                    self.pending -= 1
+                    if not self.waiting[handler]:
+                        self.running[handler] -= 1
+                        del self.waiting[handler]
+                        break
+                    params = self.waiting[handler].popleft()
+
+    def execute(self, handler, params):
+        try:
+            logging.info("handler '%s' is in charge, params: %s", handler, params)
+            handler(params)
+            return "done"
+        except HandlerTimeout as e:
+            logging.error("handler '%s' timed out: %s", handler, e)
+            return "timeouts"
+        except Exception as e:
+            logging.error("error during handler execution: %s", e)
+            return "failed"
@@ -1,109 +1,496 @@
 # -*- coding: utf-8 -*-
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from errno import EINTR
 from json import loads
 import logging
-from select import select
-from evdev import ecodes, KeyEvent
-from pybd.device import Device
-from pybd.expression import Expression, Translator
-from pybd.handler import HandlerFactory
-from pybd.utils import d_dict
+import os
+from select import epoll, EPOLLIN
+from socket import error as SocketError
+from threading import Thread
+from time import time
+from pybd.cache import MatcherCache
+from pybd.control import Control
+from pybd.device import Device, EventReader, KeyRecord
+from pybd.expression import Expression, Matcher, Translator
+from pybd.gesture import Gestures
+from pybd.handler import HandlerFactory, Limiter, NamespaceHandler, ShellWorker, Writer
+from pybd.metrics import labels, Metrics
+from pybd.pool import HandlerPool
+from pybd.record import Recorder
+from pybd.utils import Connection, d_dict, TimerWheel, Tracer, unix_server
 
 __author__ = 'iljich'
 
+class Session(object):
+    """matching state of a single device: its namespace, matcher and buffer"""
+
+    def __init__(self, device, namespace, matcher=None, reset_expression=None):
+        """without matcher session waits for expressions, see Processor.finish_compile"""
+        self.device = device
+        self.namespace = namespace
+        self.labels = labels(device=device.path if device else "none")
+        self.event_buffer = []
+        self.matcher = None
+        self.gestures = None
+        # passes keys to matching, set by the processor
+        self.emit = None
+        if matcher:
+            self.replace(matcher, reset_expression)
+
+    def replace(self, matcher, reset_expression):
+        """switches to new matcher, replaying keys of the partial match on it"""
+        self.source = matcher
+        self.matcher = matcher.fork()
+        if self.gestures:
+            self.gestures.close()
+        self.gestures = Gestures(matcher.gestures, self) if matcher.gestures else None
+        self.reset_expression = reset_expression
+        self.reset_state = reset_expression.start()
+        for event in self.event_buffer:
+            self.reset_state.advance(event)
+            if self.matcher.step(event)[0] is not Expression.state_partial:
+                self.flush()
+                break
+
+    def flush(self):
+        self.event_buffer = []
+        self.matcher.reset()
+        self.reset_state = self.reset_expression.start()
+
+
 class Processor(object):
     _instance = None
-    event_buffer = []
-    expressions = []
+    results = ["accept", "reject", "partial"]
+    result_labels = [labels(result=result) for result in results + ["reset"]]
+    # namespace -> matcher, least recently used first
+    namespaces = OrderedDict()
+    # namespace -> {(handler header, pattern, command): (expression, handler)}
+    compiled = {}
+    reload_pending = False
+    # events read while expressions are compiled, None when they are ready
+    backlog = None
+    sessions = []
     devices = []
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, start=True, record=None):
+        """
+        with start=False devices are not opened and main loop is not run;
+        record is path to log of read events, overrides "record" in config,
+        which is used only with start=True, so replays never write over it
+        """
+        self.config_path = config_path
+        self.namespaces, self.compiled = OrderedDict(), {}
+        self.sessions, self.devices = [], []
+        self.started, self.timings = time(), []
         with open(config_path) as f:
             self.config = ConfigReader(f.read())
-        self.init_logging()
-        logging.info("loading expressions")
-        self.load_expressions()
-        logging.info("initializing device")
-        self.init_device()
-        logging.debug("starting up done")
+        self.timed("logging", self.init_logging)
+        self.timers = TimerWheel()
+        self.init_buffer()
+        cache = self.config["processor"]["cache"]
+        self.cache = MatcherCache(cache) if cache else None
+        self.metrics = Metrics()
+        logging.info("starting handler pool")
+        self.timed("pool", self.init_pool)
+        self.init_poller()
+        self.init_metrics()
+        self.metrics_server = self.control = None
+        if start:
+            # a replay or test must not take sockets over from the daemon
+            self.init_servers()
+        record = record or (start and self.config["processor"]["record"])
+        self.recorder = Recorder(record) if record else None
         Processor._instance = self
+        if not start:
+            logging.info("loading expressions")
+            self.timed("expressions", self.load_namespaces)
+            return
+        # devices are read right away, keys wait in backlog till expressions are compiled
+        self.backlog = []
+        logging.info("initializing devices")
+        self.timed("devices", self.init_device)
+        logging.info("accepting input after %.1fms (%s)",
+                     (time() - self.started) * 1e3, self.timing_report())
+        logging.info("loading expressions")
+        self.compile_in_background()
         self.run()
 
     @classmethod
     def instance(cls):
         return cls._instance
 
-    def load_expressions(self, sceme="default", flush=False):
-        if flush:
-            self.expressions = []
-        Expression.set_wildchar(self.config["processor"]["input_end_key"])
-        for handler_header, expressions in self.config["expressions"][sceme].items():
-            handler_name, handler_args = self.config.split_header(handler_header)
-            Handler = HandlerFactory(handler_name, handler_args)
-            for pattern, command in expressions.items():
-                self.expressions.append((Expression(pattern), Handler(command)))
+    def load_expressions(self, sceme="default", flush=False, reuse=None):
+        reuse = reuse or {}
+        compiled = {} if flush else self.compiled.get(sceme, {})
+        bindings = [] if flush or sceme not in self.namespaces \
+            else list(self.namespaces[sceme].bindings)
+        wildchar = self.config["processor"]["input_end_key"] or "<ENTER>"
+        config = self.config["expressions"][sceme]
+        # keys of bindings, tokens of their patterns and tables of matcher, if cached
+        cacheable = self.cache and not bindings
+        cached = self.cache.get(sceme, config, wildchar) if cacheable else None
+        keys, tokens, tables = cached or ([(handler_header, pattern, command)
+                                          for handler_header, expressions in config.items()
+                                          for pattern, command in expressions.items()], None, None)
+        factories = {}
+        for number, key in enumerate(keys):
+            if key not in reuse:
+                handler_header, pattern, command = key
+                if handler_header not in factories:
+                    handler_name, handler_args = self.config.split_header(handler_header)
+                    factories[handler_header] = HandlerFactory(handler_name, handler_args)
+                reuse[key] = Expression(pattern, wildchar, tokens[number] if tokens else None), \
+                    factories[handler_header](command)
+            compiled[key] = reuse[key]
+            bindings.append(reuse[key])
+        self.compiled[sceme] = compiled
+        self.namespaces[sceme] = Matcher(bindings, tables)
+        if cacheable and not cached:
+            self.cache.put(sceme, config, wildchar, keys,
+                           [expression.tokens for expression, handler in bindings],
+                           self.namespaces[sceme].tables())
+            self.cache.save()
         # for resetting purposes
         self.reset_expression = Expression("*", self.config["processor"]["reset_key"])
 
-    def handle_event(self, event):
-        self.event_buffer.append(event)
-        logging.debug("caught key, new buffer: %s",
-            [(Translator.key_to_name(key), key.keystate) for key in self.event_buffer])
-        # a bit dirty, yet so
-        if self.reset_expression(self.event_buffer)[0] is Expression.state_accept:
-            self.flush_buffer()
-            return
-        keep = False
-        result = Expression.state_reject
-        for expression, handler in self.expressions:
-            result, extracted = expression(self.event_buffer)
-            if result is Expression.state_accept:
-                logging.info("valid expression of '%s' is caught", expression)
-                try:
-                    logging.info("handler '%s' is in charge, params: %s",
-                        handler, extracted)
-                    handler(extracted)
-                except Exception as e:
-                    logging.error("error during handler execution: %s", e)
-                keep = False
+    def add_session(self, device=None, namespace="default"):
+        if self.backlog is not None:
+            session = Session(device, namespace)
+        else:
+            session = Session(device, namespace, self.namespace(namespace), self.reset_expression)
+        session.emit = lambda event: self.match_event(event, session)
+        self.sessions.append(session)
+        return session
+
+    def namespace(self, name):
+        """matcher of namespace, compiled on first use and then kept in cache"""
+        matcher = self.namespaces.pop(name, None)
+        if matcher is None:
+            self.load_expressions(name)
+            matcher = self.namespaces.pop(name)
+        self.namespaces[name] = matcher
+        self.evict()
+        return matcher
+
+    def evict(self):
+        # least recently used namespaces go first, ones used by devices stay
+        limit = int(self.config["processor"]["namespace_cache"] or 8)
+        used = set(session.namespace for session in self.sessions)
+        for name in list(self.namespaces):
+            if len(self.namespaces) <= limit:
                 break
-            elif result is Expression.state_partial:
-                keep = True
-            elif result is Expression.state_reject:
-                pass
+            if name not in used:
+                logging.info("namespace %s is dropped from cache", name)
+                self.close_handlers(self.compiled.pop(name).values())
+                del self.namespaces[name]
+
+    def close_handlers(self, bindings, keep=()):
+        # delayed runs of handlers no longer bound are cancelled
+        keep = set(handler for compiled in keep for expression, handler in compiled.values())
+        for expression, handler in bindings:
+            if handler.limiter and handler not in keep:
+                handler.limiter.close()
+
+    def switch_namespace(self, session, name):
+        if self.config["expressions"][name] is None:
+            logging.error("no namespace %s to switch to", name)
+            return False
+        logging.info("switching to namespace %s", name)
+        session.namespace = name
+        session.flush()
+        session.replace(self.namespace(name), self.reset_expression)
+        return True
+
+    def compile_in_background(self):
+        read, write = os.pipe()
+        self.compile_done = os.fdopen(read)
+        self.compile_error = None
+        self.listen(self.compile_done, self.finish_compile)
+
+        def compile():
+            try:
+                self.timed("expressions", self.load_namespaces)
+            except Exception as e:
+                self.compile_error = e
+            # wakes main loop up
+            os.write(write, "\n")
+            os.close(write)
+
+        thread = Thread(target=compile, name="compile")
+        thread.daemon = True
+        thread.start()
+
+    def load_namespaces(self):
+        # "preload" namespaces are compiled in advance, to be switched to without delay
+        namespaces = (self.config["processor"]["preload"] or []) + ["default"] \
+            + [session.namespace for session in self.sessions]
+        for namespace in sorted(set(namespaces)):
+            self.namespace(namespace)
+
+    def finish_compile(self):
+        self.forget(self.compile_done)
+        self.compile_done.close()
+        if self.compile_error:
+            raise self.compile_error
+        for session in self.sessions:
+            session.replace(self.namespaces[session.namespace], self.reset_expression)
+        backlog, self.backlog = self.backlog, None
+        for event, session in backlog:
+            self.handle_event(event, session)
+        logging.info("expressions ready after %.1fms (%s), %d keys were waiting",
+                     (time() - self.started) * 1e3, self.timing_report(), len(backlog))
+
+    def timed(self, phase, function):
+        start = time()
+        result = function()
+        self.timings.append((phase, time() - start))
+        return result
+
+    def timing_report(self):
+        return ", ".join("%s %.1fms" % (phase, took * 1e3) for phase, took in self.timings)
+
+    def schedule_reload(self):
+        # called from signal handler, actual reload is done by main loop
+        self.reload_pending = True
+
+    def reload(self):
+        """
+        Re-reads config and swaps in changed namespaces. Unchanged namespaces
+        are kept as is, changed ones reuse expressions and handlers that
+        are still in config. Devices are not touched.
+        """
+        self.reload_pending = False
+        logging.info("reloading config")
+        old = self.config, self.namespaces, self.compiled, self.reset_expression
+        try:
+            with open(self.config_path) as f:
+                self.config = ConfigReader(f.read())
+            # of processor settings only these two are compiled into expressions
+            same_keys = all(self.config["processor"][key] == old[0]["processor"][key]
+                            for key in ("input_end_key", "reset_key"))
+            self.namespaces, self.compiled = OrderedDict(), {}
+            for sceme in old[1]:
+                if self.config["expressions"][sceme] is None:
+                    if sceme in [session.namespace for session in self.sessions]:
+                        raise ValueError("namespace %s is in use" % sceme)
+                    continue
+                if same_keys and self.config["expressions"][sceme] == old[0]["expressions"][sceme]:
+                    self.namespaces[sceme], self.compiled[sceme] = old[1][sceme], old[2][sceme]
+                    continue
+                logging.info("recompiling namespace %s", sceme)
+                self.load_expressions(sceme, True, dict(old[2][sceme]) if same_keys else {})
+            if same_keys:
+                self.reset_expression = old[3]
+        except Exception as e:
+            logging.error("config is not reloaded: %s", e)
+            self.config, self.namespaces, self.compiled, self.reset_expression = old
+            return
+        for compiled in old[2].values():
+            self.close_handlers(compiled.values(), self.compiled.values())
+        for session in self.sessions:
+            matcher = self.namespaces[session.namespace]
+            if matcher is not session.source or self.reset_expression is not old[3]:
+                session.replace(matcher, self.reset_expression)
+        if self.config["processor"]["loglevel"]:
+            logging.getLogger().setLevel(self.config["processor"]["loglevel"])
+        self.tracer = Tracer(self.config["processor"]["trace_sample"] or 1)
+        self.init_buffer()
+        logging.info("config reloaded")
+
+    def handle_event(self, event, session=None):
+        session = session or self.sessions[0]
+        if event.__class__ is not KeyRecord:
+            # evdev KeyEvent, e.g. of tests and benchmark, has no timestamp()
+            event = KeyRecord(event.scancode, event.keystate, event.event.sec, event.event.usec)
+        if session.gestures:
+            session.gestures.feed(event)
+        else:
+            self.match_event(event, session)
+
+    def match_event(self, event, session):
+        if session.event_buffer:
+            self.check_buffer(event, session)
+        session.event_buffer.append(event)
+        trace = self.tracer.enabled and self.tracer.start(event, session.event_buffer)
+        if session.reset_state.advance(event) is Expression.state_accept:
+            session.flush()
+            self.metrics.inc("pybd_keys_total", self.result_labels[-1])
+            if trace:
+                self.tracer.emit(trace, "reset")
+            return
+        result, binding, extracted = session.matcher.step(event)
+        self.metrics.inc("pybd_keys_total", self.result_labels[result])
+        if result is Expression.state_accept:
+            expression, handler = binding
+            logging.info("valid expression of '%s' is caught", expression)
+            self.metrics.inc("pybd_matches_total", labels(namespace=session.namespace, expression=expression))
+            if handler.limiter:
+                action = handler.limiter.submit(event.timestamp(),
+                                                lambda: self.dispatch(handler, extracted, session))
+                if action:
+                    logging.info("'%s' is %s by limits of its handler", expression, action)
+                    self.metrics.inc("pybd_handler_limited_total",
+                                     labels(handler=handler.product_name, action=action))
             else:
-                raise AttributeError("Unexpected expression reply")
-        logging.debug("reply: %s", ["accept", "reject", "partial"][result])
-        if not keep:
-            self.flush_buffer()
+                self.dispatch(handler, extracted, session)
+        if trace:
+            self.tracer.emit(trace, self.results[result],
+                binding and binding[0], extracted)
+        if result is not Expression.state_partial:
+            session.flush()
 
-    def flush_buffer(self):
-        self.event_buffer = []
+    def check_buffer(self, event, session):
+        """drops partial input that is too old or too long, before event is added"""
+        if self.idle_timeout and \
+                event.timestamp() - session.event_buffer[-1].timestamp() > self.idle_timeout:
+            logging.info("partial input is dropped after %s seconds of idle", self.idle_timeout)
+            session.flush()
+        elif len(session.event_buffer) >= self.buffer_size:
+            logging.warning("partial input is dropped, it is longer than %d keys", self.buffer_size)
+            session.flush()
+
+    def dispatch(self, handler, extracted, session):
+        if isinstance(handler, NamespaceHandler):
+            self.switch_namespace(session, handler.apply(extracted))
+        else:
+            self.pool.submit(handler, extracted)
+
+    def init_buffer(self):
+        config = self.config["processor"]
+        self.buffer_size = int(config["buffer_size"] or 256)
+        self.idle_timeout = float(config["idle_timeout"] or 0)
+        Gestures.wheel = Limiter.wheel = self.timers
+        Gestures.hold_time = int(config["hold_time"] or 500)
+        Gestures.tap_window = int(config["tap_window"] or 300)
+
+    def init_pool(self):
+        config = self.config["processor"]
+        self.pool = HandlerPool(int(config["workers"] or 4), int(config["queue_size"] or 64), self.metrics)
+
+    def init_metrics(self):
+        self.metrics.gauge("pybd_buffer_depth",
+            lambda: dict((session.labels, len(session.event_buffer)) for session in self.sessions))
+
+    def init_servers(self):
+        path = self.config["processor"]["metrics_socket"]
+        if path:
+            self.metrics_server = unix_server(path)
+            self.listen(self.metrics_server, self.serve_metrics)
+        path = self.config["processor"]["control_socket"]
+        if path:
+            self.control = Control(self, path)
+
+    def serve_metrics(self):
+        """answers any request with metrics, as HTTP response, e.g. to curl --unix-socket"""
+        try:
+            connection = self.metrics_server.accept()[0]
+        except SocketError:
+            return
+        Connection(self, connection, self.metrics_response, timeout=5, close_after_reply=True)
+
+    def metrics_response(self, request):
+        body = self.metrics.render()
+        return ("HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                "Content-Length: %d\r\n\r\n%s" % (len(body), body))
+
+    def init_poller(self):
+        self.poller = epoll()
+        self.listeners = {}
+        self.display_hook = lambda display: self.listen(display, Translator.handle_x_events)
+        Translator.display_hooks.append(self.display_hook)
+        if Translator.display:
+            self.listen(Translator.display, Translator.handle_x_events)
+
+    def listen(self, source, callback, events=EPOLLIN):
+        if source.fileno() in self.listeners:
+            self.poller.modify(source.fileno(), events)
+        else:
+            self.poller.register(source.fileno(), events)
+        self.listeners[source.fileno()] = callback
+
+    def forget(self, source):
+        self.poller.unregister(source.fileno())
+        del self.listeners[source.fileno()]
+
+    def device_configs(self):
+        # "devices" is a list of device sections, single "device" is still fine
+        for config in self.config["devices"] or [self.config["device"]]:
+            config = dict(config)
+            namespace = config.pop("namespace", "default")
+            yield config, namespace
 
     def init_device(self):
-        device = Device(**self.config["device"])
-        self.devices.append(device)
+        for config, namespace in self.device_configs():
+            device = Device(**config)
+            self.devices.append(device)
+            session = self.add_session(device, namespace)
+            self.listen(device.listener,
+                lambda number=len(self.sessions) - 1: self.read_device(number))
 
     def exit(self):
         logging.info("cleaning up")
+        logging.info("handler pool stats: %s", dict(self.pool.stats))
+        for device in self.devices:
+            if device.reader.drops:
+                logging.info("events of %s were lost %d times", device.path, device.reader.drops)
+        if self.control:
+            self.control.close()
+        if self.metrics_server:
+            os.unlink(self.metrics_server.getsockname())
+            self.metrics_server.close()
+        Writer.close_all()
+        ShellWorker.stop_all()
+        if self.recorder:
+            self.recorder.close()
         for device in self.devices:
             device.exit()
+        Translator.display_hooks.remove(self.display_hook)
+
+    def read_device(self, number):
+        session = self.sessions[number]
+        records = session.device.reader.read()
+        self.metrics.inc("pybd_events_total", session.labels, len(records))
+        for record in records:
+            if record is EventReader.dropped:
+                logging.warning("events of %s were lost, partial input is dropped", session.device.path)
+                self.metrics.inc("pybd_events_lost_total", session.labels)
+                self.drop_input(session)
+                continue
+            if self.recorder:
+                self.recorder.write(number, record)
+            if self.backlog is not None:
+                self.backlog.append((record, session))
+            else:
+                self.handle_event(record, session)
+
+    def drop_input(self, session):
+        if self.backlog is not None:
+            self.backlog = [item for item in self.backlog if item[1] is not session]
+        else:
+            session.flush()
 
     def run(self):
         logging.info("starting main loop")
         while True:
-            readable, w, x = select([device.listener for device in self.devices], [], [])
-            events = [event for device in readable for event in device.read()
-                      if event.type == ecodes.EV_KEY
-                        and KeyEvent(event).keystate is not KeyEvent.key_hold]
-            if events:
-                for event in events:
-                    self.handle_event(KeyEvent(event))
+            try:
+                ready = self.poller.poll(self.timers.timeout(time()))
+            except IOError as e:
+                # signal came while waiting
+                if e.errno != EINTR:
+                    raise
+                ready = []
+            self.metrics.inc("pybd_wakeups_total")
+            for fd, mask in ready:
+                self.listeners[fd]()
+            self.timers.expire(time())
+            if self.reload_pending and self.backlog is None:
+                self.reload()
 
     def init_logging(self):
         logging.basicConfig(level=self.config["processor"]["loglevel"],
             format='%(asctime)s : [%(levelname)s]  %(message)s',
             filename=self.config["processor"]["logfile"], filemode="w+")
+        self.tracer = Tracer(self.config["processor"]["trace_sample"] or 1)
         logging.info("Logging system initialized")
 
 
@@ -112,6 +499,7 @@ class ConfigReader():
     config = d_dict({})
 
     def __init__(self, config="{}"):
+        self.config = d_dict({})
         self.load(config)
 
     def load(self, config=""):
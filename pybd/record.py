@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from struct import Struct
+from time import sleep, time
+from pybd.device import KeyRecord
+
+__author__ = 'iljich'
+
+class Recorder(object):
+    """
+    Writes key events read by the processor into a compact binary log:
+    a header, then 12 bytes per event - kernel time, device number,
+    key code and key state.
+    """
+    magic = "PYBD\x01"
+    record = Struct("<IIBHB")
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(self.magic)
+
+    def write(self, device, key):
+        self.file.write(self.record.pack(key.sec, key.usec, device, key.scancode, key.keystate))
+
+    def close(self):
+        self.file.close()
+
+def read_log(path, chunk=4096):
+    size = Recorder.record.size
+    with open(path, "rb") as f:
+        if f.read(len(Recorder.magic)) != Recorder.magic:
+            raise ValueError("%s is not a pybd event log" % path)
+        while True:
+            data = f.read(size * chunk)
+            for offset in range(0, len(data) - size + 1, size):
+                yield Recorder.record.unpack_from(data, offset)
+            if len(data) < size * chunk:
+                break
+
+def replay(processor, path, speed=1.0):
+    """
+    Feeds events from log to processor sessions, keeping original pauses
+    divided by speed. Speed 0 replays as fast as possible.
+    Returns number of events and time it took.
+    """
+    started = time()
+    first = None
+    count = 0
+    for sec, usec, device, code, value in read_log(path):
+        if speed:
+            stamp = sec + usec / 1e6
+            first = stamp if first is None else first
+            delay = started + (stamp - first) / speed - time()
+            if delay > 0:
+                sleep(delay)
+        session = processor.sessions[device if device < len(processor.sessions) else 0]
+        # timers run on recorded time, whatever the speed is
+        processor.timers.expire(sec + usec / 1e6)
+        processor.handle_event(KeyRecord(code, value, sec, usec), session)
+        count += 1
+    if count:
+        processor.timers.expire(sec + usec / 1e6 + 3600)
+    return count, time() - started
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+Helper of ShellHandler, started once per user by ShellWorker.
+Reads commands as json lines from stdin, runs each one with `sh -c`,
+params being its positional arguments, and writes back exit codes.
+Exits when stdin is closed. Uses nothing but standard library, as it
+is passed to interpreter as a string and runs as another user.
+"""
+import os
+import signal
+import sys
+from json import dumps, loads
+from subprocess import Popen
+from threading import Lock, Thread, Timer
+
+__author__ = 'iljich'
+
+lock = Lock()
+
+def kill(process):
+    # command runs in its own process group, so its children are killed too
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def wait(request, process):
+    timer = Timer(request["timeout"], kill, (process,)) if request["timeout"] else None
+    if timer:
+        timer.start()
+    code = process.wait()
+    if timer:
+        timer.cancel()
+    with lock:
+        sys.stdout.write(dumps({"id": request["id"], "code": code}) + "\n")
+        sys.stdout.flush()
+
+def serve():
+    devnull = open(os.devnull, "r+")
+    for line in iter(sys.stdin.readline, ""):
+        request = loads(line)
+        try:
+            process = Popen(["sh", "-c", request["cmd"], "sh"] + request["args"],
+                            stdin=devnull, stdout=devnull, preexec_fn=os.setsid)
+        except OSError as e:
+            sys.stderr.write("can not run %s: %s\n" % (request["cmd"], e))
+            with lock:
+                sys.stdout.write(dumps({"id": request["id"], "code": 127}) + "\n")
+                sys.stdout.flush()
+            continue
+        thread = Thread(target=wait, args=(request, process))
+        thread.daemon = True
+        thread.start()
+
+if __name__ == "__main__":
+    serve()
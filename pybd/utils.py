@@ -1,15 +1,16 @@
 # -*- coding: utf-8 -*-
+from errno import EADDRINUSE, EAGAIN, ECONNREFUSED
+from json import dumps
 import logging
 import os
-from re import findall
-from select import select
-from subprocess import PIPE, Popen
-from time import sleep
-from daemon.pidlockfile import PIDLockFile
+from select import select, EPOLLIN, EPOLLOUT
+from socket import error as SocketError, socket, AF_UNIX, SOCK_STREAM
+from stat import S_ISSOCK
+from time import sleep, time
 from evdev import InputDevice
 from evdev import ecodes
 from evdev.events import KeyEvent
-from lockfile import NotMyLock, NotLocked
+from pybd.device import XInput
 from pybd.expression import Translator
 
 __author__ = 'iljich'
@@ -50,10 +51,227 @@ class FileLikeLogger(object):
         for handler in self.logger.handlers:
             handler.close()
 
+class lazy(object):
+    """log argument, that is computed only if the record is actually formatted"""
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        return str(self.function(*self.args, **self.kwargs))
+
+class Tracer(object):
+    """
+    Structured per-event trace records of the processor, logged on DEBUG level.
+    Only every `sample`-th event is traced. Level is checked in `update`, so
+    with tracing off an event costs a single attribute check.
+    """
+
+    def __init__(self, sample=1, logger="root"):
+        self.logger = logging.getLogger(logger)
+        self.sample = max(int(sample), 1)
+        self.counter = 0
+        self.update()
+
+    def update(self):
+        self.enabled = self.logger.isEnabledFor(logging.DEBUG)
+
+    def start(self, event, buffer):
+        self.counter += 1
+        if self.counter % self.sample:
+            return None
+        return {
+            "seq": self.counter,
+            "start": time(),
+            "key": Translator.key_to_name(event),
+            "keystate": event.keystate,
+            "buffer": [(Translator.key_to_name(key), key.keystate) for key in buffer],
+        }
+
+    def emit(self, record, result, expression=None, extracted=None):
+        record["took_us"] = int((time() - record.pop("start")) * 1e6)
+        record["result"] = result
+        if expression:
+            record["expression"] = str(expression)
+            record["params"] = extracted
+        self.logger.debug("trace: %s", lazy(dumps, record, sort_keys=True))
+
+class TimerWheel(object):
+    """
+    Hashed timer wheel of the main loop: `size` slots of `tick` seconds.
+    Scheduling and cancelling cost the same for any number of timers,
+    and with no timers pending the loop just waits for input.
+    Time is passed in, so replays can run timers on recorded time.
+    """
+
+    def __init__(self, tick=0.005, size=512):
+        self.tick = tick
+        self.size = size
+        self.slots = [[] for i in range(size)]
+        self.current = None
+        self.count = 0
+        self.counter = 0
+
+    def schedule(self, when, callback):
+        """runs callback(when) at time `when`; returns timer to cancel"""
+        due = int(when / self.tick)
+        if self.current is None or due < self.current:
+            self.current = due
+        self.counter += 1
+        timer = [due, self.counter, callback, when]
+        self.slots[due % self.size].append(timer)
+        self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        # removed from its slot when the slot is expired
+        if timer[2] is not None:
+            timer[2] = None
+            self.count -= 1
+
+    def timeout(self, now):
+        """seconds till the nearest timer, -1 if there are none"""
+        if not self.count:
+            return -1
+        for tick in xrange(self.current, self.current + self.size):
+            due = [timer[3] for timer in self.slots[tick % self.size]
+                   if timer[0] == tick and timer[2] is not None]
+            if due:
+                return max(min(due) - now, 0)
+        # timers of later rounds only
+        return self.size * self.tick
+
+    def expire(self, now):
+        """runs timers due by `now`, in order, including ones scheduled by them"""
+        target = int(now / self.tick)
+        if not self.count:
+            self.current = target
+            return
+        while self.run_due(now, target) and self.count and self.current <= target:
+            pass
+
+    def run_due(self, now, target):
+        due = []
+        for tick in xrange(self.current, min(target + 1, self.current + self.size)):
+            slot = self.slots[tick % self.size]
+            if slot:
+                due += [timer for timer in slot if timer[0] <= target]
+                slot[:] = [timer for timer in slot if timer[0] > target]
+        self.current = target + 1
+        fired = 0
+        for timer in sorted(due):
+            if timer[2] is not None and timer[3] <= now:
+                callback, timer[2] = timer[2], None
+                self.count -= 1
+                fired += 1
+                callback(timer[3])
+            elif timer[2] is not None:
+                # same tick, but a bit later than now
+                self.slots[timer[0] % self.size].append(timer)
+                self.current = min(self.current, timer[0])
+        return fired
+
+def unix_server(path, mode=None):
+    """
+    non-blocking listening unix socket, created with permissions `mode`;
+    socket left by previous run is replaced, one still served by another
+    process is not
+    """
+    if os.path.exists(path) and S_ISSOCK(os.stat(path).st_mode):
+        probe = socket(AF_UNIX, SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except SocketError as e:
+            if e.errno != ECONNREFUSED:
+                raise
+            os.unlink(path)
+        else:
+            raise SocketError(EADDRINUSE, "%s is served by another process" % path)
+        finally:
+            probe.close()
+    server = socket(AF_UNIX, SOCK_STREAM)
+    # socket gets its permissions on bind, it is never open to others
+    umask = os.umask(0777 & ~mode) if mode is not None else None
+    try:
+        server.bind(path)
+    finally:
+        if umask is not None:
+            os.umask(umask)
+    server.listen(16)
+    server.setblocking(False)
+    return server
+
+class Connection(object):
+    """
+    Client of a unix server, served from processor's main loop without
+    blocking it. Data read is passed to `receive`, which returns data to
+    send back; it is sent as fast as client reads it, up to `limit` bytes
+    are kept. Connection is closed when client closes it, after `timeout`
+    seconds, or with close_after_reply after first reply is sent.
+    """
+    limit = 1 << 20
+
+    def __init__(self, processor, connection, receive, timeout=None, close_after_reply=False):
+        self.processor = processor
+        self.connection = connection
+        self.receive = receive
+        self.close_after_reply = close_after_reply
+        self.output = ""
+        self.closed = False
+        self.timer = timeout and processor.timers.schedule(time() + timeout, lambda when: self.close())
+        connection.setblocking(False)
+        processor.listen(connection, self.ready)
+
+    def ready(self):
+        if self.output:
+            self.send()
+        if self.closed:
+            return
+        try:
+            data = self.connection.recv(65536)
+        except SocketError as e:
+            if e.errno == EAGAIN:
+                return
+            data = ""
+        if not data:
+            self.close()
+            return
+        reply = self.receive(data)
+        if reply:
+            if len(self.output) + len(reply) > self.limit:
+                logging.warning("client of %s does not read replies, closing it",
+                                self.connection.getsockname())
+                self.close()
+                return
+            self.output += reply
+            self.send()
+
+    def send(self):
+        try:
+            self.output = self.output[self.connection.send(self.output):]
+        except SocketError as e:
+            if e.errno != EAGAIN:
+                self.close()
+                return
+        if not self.output and self.close_after_reply:
+            self.close()
+            return
+        # waits for the socket to be writable only while there is output
+        self.processor.listen(self.connection, self.ready, EPOLLIN | (EPOLLOUT if self.output else 0))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.timer:
+            self.processor.timers.cancel(self.timer)
+        self.processor.forget(self.connection)
+        self.connection.close()
+
 def input_devices():
-    devices = Popen(["xinput"], stdout=PIPE).communicate()[0]
-    params = findall(r"\b([a-zA-Z0-9 _.]+?)\s*id=(\d*)", devices)
-    return params
+    return [(device.name, device.xid) for device in XInput.devices()]
 
 def listen_device(device):
     sleep(1)
@@ -72,15 +290,3 @@ def listen_device(device):
             if name:
                 print name
 
-
-class MyPIDLockFile(PIDLockFile):
-
-    def acquire(self, *args, **kwargs):
-        try:
-            self.release()
-        except NotMyLock:
-            if not os.path.exists("/proc/%s" % self.read_pid()):
-                self.break_lock()
-        except NotLocked:
-            pass
-        super(MyPIDLockFile, self).acquire(*args, **kwargs)
\ No newline at end of file
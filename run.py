@@ -1,23 +1,54 @@
 # -*- coding: utf-8 -*-
 from argparse import ArgumentParser
-from signal import SIGTERM, SIGHUP
-from daemon import daemon
-from pybd.device import Device
-from pybd.processor import Processor
-from pybd.utils import FileLikeLogger, input_devices, listen_device, MyPIDLockFile
 from os import path
 
 __author__ = 'iljich'
 
+# modules are imported in the branches that use them, so help and
+# argument errors are printed without loading X, evdev and daemon
+
 parser = ArgumentParser()
 parser.add_argument("-i", "--interactive", action="store_true",
     help="interactive tool for testing devices output")
 parser.add_argument("-c", "--config", help="path to config file")
 parser.add_argument("-p", "--pidfile", help="path to pid file", default="/var/run/pybd.pid")
+parser.add_argument("--record", help="write key events read from devices to this file")
+parser.add_argument("--replay", help="feed events from file written with --record "
+                                     "to processor, instead of running daemon")
+parser.add_argument("--speed", type=float, default=1.0,
+    help="replay speed multiplier, 0 - as fast as possible")
+parser.add_argument("--stub", action="store_true", help="replay with dummy handlers")
 
 args = parser.parse_args()
 
-if args.config and not args.interactive:
+if args.config and args.replay:
+
+    from time import sleep
+    from pybd.handler import HandlerFactory
+    from pybd.processor import Processor
+    from pybd.record import replay
+
+    if args.stub:
+        HandlerFactory.stubbed = True
+    p = Processor(path.abspath(args.config), start=False,
+                  record=args.record and path.abspath(args.record))
+    for config, namespace in p.device_configs():
+        p.add_session(None, namespace)
+    count, took = replay(p, args.replay, args.speed)
+    while p.pool.depth():
+        sleep(0.01)
+    print "%d events in %.3fs, %.0f events/s" % (count, took, count / took if took else 0)
+    print "handlers: %s" % dict(p.pool.stats)
+    # writes out batched and pending pipe data
+    p.exit()
+
+elif args.config and not args.interactive:
+
+    from signal import SIGTERM, SIGHUP
+    from daemon import daemon
+    from pybd.pidfile import MyPIDLockFile
+    from pybd.processor import Processor
+    from pybd.utils import FileLikeLogger
 
     context = daemon.DaemonContext(
         pidfile=MyPIDLockFile(args.pidfile),
@@ -28,15 +59,18 @@ if args.config and not args.interactive:
 
     context.signal_map = {
         SIGTERM: lambda s,f: Processor.instance().exit(),
-        #SIGHUP: lambda s,f: Processor.instance().exit()
+        SIGHUP: lambda s,f: Processor.instance().schedule_reload()
     }
 
     config_path = path.abspath(args.config)
 
     with context:
-        p = Processor(config_path)
+        p = Processor(config_path, record=args.record and path.abspath(args.record))
+
+elif args.interactive:
 
-if args.interactive:
+    from pybd.device import Device
+    from pybd.utils import input_devices, listen_device
 
     print "Available devices:"
     for name, xid in input_devices():
@@ -1,13 +1,26 @@
 # -*- coding: utf-8 -*-
-from itertools import permutations
+from fcntl import fcntl, F_SETFL
+from itertools import permutations, product
+import os
 from os.path import dirname
-from subprocess import CalledProcessError
-from tempfile import NamedTemporaryFile
-from evdev import KeyEvent, InputEvent
-from pybd.device import Device, DeviceError
-from pybd.expression import Expression, Translator
-from pybd.handler import HandlerFactory
+from pwd import getpwuid
+from random import Random
+from shutil import rmtree
+from subprocess import PIPE, Popen
+from socket import error as SocketError, socket, AF_UNIX, SOCK_STREAM
+from tempfile import mkdtemp, NamedTemporaryFile
+from threading import Event
+from json import dumps, loads
+from evdev import KeyEvent, InputDevice, InputEvent
+from pybd.cache import MatcherCache
+from pybd.device import Device, DeviceError, EventReader, KeyRecord, switch
+from pybd.expression import Expression, Matcher, Translator
+from pybd.handler import AbstractHandler, DummyHandler, HandlerFactory, HandlerTimeout, Limiter, ShellWorker, Writer
+from pybd.pool import HandlerPool
+import pybd.processor
 from pybd.processor import Processor, ConfigReader
+from pybd.record import read_log, Recorder, replay
+from pybd.utils import TimerWheel, Tracer, unix_server
 
 __author__ = 'iljich'
 
@@ -38,7 +51,7 @@ class DeviceManagerTest(TestCase):
         self.assertRaises(DeviceError, Device, None, "Nonexistent")
         self.assertRaises(DeviceError, Device, 22)
         self.device.xid = "Dummy"
-        self.assertRaises(CalledProcessError, self.device.set_state, 0)
+        self.assertRaises(DeviceError, self.device.set_state, 0)
 
     def test_set_state(self):
         self.device.set_state(0)
@@ -56,6 +69,68 @@ class DeviceManagerTest(TestCase):
         d1 = Device(path=d.path)
         self.assertEqual(d.xid, d1.xid)
 
+class DeviceTest(TestCase):
+    """parts of Device that need no real device"""
+    def test_switch(self):
+        self.assertEqual([switch(value) for value in [True, 1, "1", False, 0, "0"]],
+                         [True, True, True, False, False, False])
+        self.assertRaises(ValueError, switch, "yes")
+        self.assertRaises(ValueError, Device, path="/dev/null", grab="off")
+
+    def test_pipe(self):
+        read, write = os.pipe()
+        device = Device.__new__(Device)
+        device.path, device.grabbed = "pipe", False
+        # InputDevice of a pipe, on which evdev ioctls fail
+        device.listener = InputDevice.__new__(InputDevice)
+        device.listener.fd = read
+        # without EVIOCSMASK all events are read
+        device.mask_events()
+        self.assertRaises(DeviceError, device.set_grabbed, True)
+        self.assertFalse(device.grabbed)
+        # nothing to do, as state is not changed
+        device.set_grabbed(False)
+        device.grabbed = True
+        self.assertRaises(DeviceError, device.set_grabbed, False)
+        self.assertTrue(device.grabbed)
+        os.close(read)
+        os.close(write)
+
+class EventReaderTest(TestCase):
+    def test_read(self):
+        read, write = os.pipe()
+        # as evdev opens devices
+        fcntl(read, F_SETFL, os.O_NONBLOCK)
+        reader = EventReader(read, lambda: [], count=4)
+        self.assertEqual(reader.read(), [])
+        # press with scan code and sync, autorepeat, release
+        events = [(1, 10, 4, 4, 30), (1, 10, 1, 30, 1), (1, 10, 0, 0, 0), (1, 20, 1, 30, 2),
+                  (1, 30, 1, 30, 0), (1, 30, 0, 0, 0)]
+        os.write(write, "".join(EventReader.event.pack(*event) for event in events))
+        records = reader.read() + reader.read()
+        self.assertEqual([(r.scancode, r.keystate, r.timestamp()) for r in records],
+                         [(30, 1, 1.00001), (30, 0, 1.00003)])
+        os.close(read)
+        os.close(write)
+
+    def test_dropped(self):
+        read, write = os.pipe()
+        fcntl(read, F_SETFL, os.O_NONBLOCK)
+        pressed = [30, 31]
+        reader = EventReader(read, lambda: pressed)
+        # 30 and 32 are released while events are lost, 33 is still pressed
+        pressed = [31, 33]
+        events = [(1, 0, 0, 3, 0), (1, 0, 1, 32, 1), (1, 0, 0, 0, 0),
+                  (2, 0, 1, 34, 1), (2, 0, 0, 0, 0)]
+        os.write(write, "".join(EventReader.event.pack(*event) for event in events))
+        records = reader.read()
+        self.assertEqual(records[0], EventReader.dropped)
+        self.assertEqual([(r.scancode, r.keystate) for r in records[1:]], [(30, 0), (34, 1)])
+        self.assertEqual(reader.pressed, set([31, 33, 34]))
+        self.assertEqual(reader.drops, 1)
+        os.close(read)
+        os.close(write)
+
 class ExpressionTest(TestCase):
 
     def test_function(self):
@@ -98,6 +173,23 @@ class ExpressionTest(TestCase):
                                                    ["sequence", ["literal", ["button", "b"]]]]], ""))
         self.assertEqual(ex.parse("<Enter>a"), (["sequence" ,["literal", ["button", "<Enter>"]],
                                                     ["sequence", ["literal", ["button", "a"]]]], ""))
+        self.assertEqual(ex.parse("[ab]c~8"), (["sequence", ["literal", ["chord", "[", ["chord_keys",
+                                                   ["button", "a"], ["chord_keys", ["button", "b"]]], "]"]],
+                                               ["sequence", ["literal", ["gesture", ["button", "c"], "~8"]]]], ""))
+        for pattern, error in [("ab!", "'!' at position 2"), ("a[b~]", "'~' at position 3"),
+                               ("*^2", "'^' at position 1"), ("a]", "']' at position 1"),
+                               ("a[]", "empty chord at position 2"), ("[ab", "chord is not closed")]:
+            with self.assertRaises(ValueError) as caught:
+                Expression(pattern)
+            self.assertIn(error, str(caught.exception))
+
+    def test_long(self):
+        names = ["a", "b", "<Enter>", "<Space>"]
+        pattern = "".join(names[i % 4] for i in range(5000)) + "*"
+        expression = Expression(pattern)
+        self.assertEqual(len(expression.tokens), 5001)
+        self.assertEqual(expression.tokens[-2:], [("button", 57), ("wild", 28)])
+        self.assertEqual(Expression(pattern + "[ab]").tokens[:5001], expression.tokens)
 
     def test_compile(self):
         ex = Expression()
@@ -131,6 +223,78 @@ class ExpressionTest(TestCase):
         self.assertEqual(result, Expression.state_accept)
         self.assertEqual(extracted, [])
 
+class MatcherTest(TestCase):
+    def setUp(self):
+        # button device translates codes without X server
+        Translator.set_device_type("button")
+
+    def tearDown(self):
+        Translator.set_device_type("key")
+
+    def loop(self, bindings, keys):
+        # what processor did before matcher: ask every expression in order
+        keep = False
+        for expression, handler in bindings:
+            result, extracted = expression(keys)
+            if result is Expression.state_accept:
+                return result, handler, extracted
+            keep = keep or result is Expression.state_partial
+        return Expression.state_partial if keep else Expression.state_reject, None, []
+
+    def test_equivalence(self):
+        atoms = ["<0>", "<1>", "*"]
+        patterns = ["".join(p) for n in range(1, 4) for p in product(atoms, repeat=n)]
+        bindings = [(Expression(p, "<TOUCH>"), n) for n, p in enumerate(patterns)]
+        matcher = Matcher(bindings)
+        # as built from tables of cache
+        loaded = Matcher(bindings, matcher.tables())
+        codes = [Translator.char_to_code(c) for c in ["0", "1", "2", "TOUCH"]]
+        random = Random(0)
+        keys = []
+        for i in range(5000):
+            key = KeyEvent(InputEvent(0, 0, 1, random.choice(codes), random.choice([0, 1])))
+            keys.append(key)
+            expected = self.loop(bindings, keys)
+            result, binding, extracted = matcher.step(key)
+            self.assertEqual((result, binding and binding[1], extracted), expected)
+            self.assertEqual(loaded.step(key), (result, binding, extracted))
+            if result is not Expression.state_partial:
+                keys = []
+
+    def test_expression_state(self):
+        codes = [Translator.char_to_code(c) for c in ["0", "1", "TOUCH"]]
+        random = Random(1)
+        for pattern in ["<0>", "<0><1>", "*", "<1>*<0>", "**"]:
+            expression = Expression(pattern, "<TOUCH>")
+            for i in range(200):
+                keys = [KeyEvent(InputEvent(0, 0, 1, random.choice(codes), random.choice([0, 1])))
+                        for n in range(random.randint(1, 6))]
+                state = expression.start()
+                for n, key in enumerate(keys):
+                    result = state.advance(key)
+                    expected = expression(keys[:n + 1])
+                    self.assertEqual(result, expected[0])
+                    if result is Expression.state_accept:
+                        self.assertEqual(state.reply(), expected[1])
+
+    def test_wildchar(self):
+        # end key is of the expression, not of the one made last
+        expression = Expression("<0>*", "<TOUCH>")
+        Expression("*", "<1>")
+        keys = [KeyEvent(InputEvent(0, 0, 1, code, 1)) for code in [256, 258, 330]]
+        self.assertEqual(expression(keys), (Expression.state_accept, ["<2>"]))
+        state = expression.start()
+        self.assertEqual([state.advance(key) for key in keys][-1], Expression.state_accept)
+
+    def test_priority(self):
+        bindings = [(Expression("<0>*", "<TOUCH>"), 0), (Expression("*", "<TOUCH>"), 1)]
+        matcher = Matcher(bindings)
+        key = lambda name: KeyEvent(InputEvent(0, 0, 1, Translator.char_to_code(name), 1))
+        self.assertEqual(matcher.step(key("0"))[0], Expression.state_partial)
+        self.assertEqual(matcher.step(key("1"))[0], Expression.state_partial)
+        self.assertEqual(matcher.step(key("TOUCH")), (Expression.state_accept, bindings[0], ["<1>"]))
+        self.assertEqual(matcher.step(key("TOUCH")), (Expression.state_accept, bindings[1], [""]))
+
 class HandlerTest(TestCase):
     def test_pipehandler(self):
         tmp = NamedTemporaryFile(delete=False)
@@ -142,6 +306,38 @@ class HandlerTest(TestCase):
             self.assertEqual(f.read(), "test")
         tmp.unlink(tmp.name)
 
+    def test_pipehandler_fifo(self):
+        path = mkdtemp() + "/fifo"
+        os.mkfifo(path)
+        Handler = HandlerFactory("pipe", {"path": path})
+        Handler("first ")([])  # nobody reads yet, must not block
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        Handler("second")([])
+        self.assertEqual(os.read(reader, 100), "first second")
+        os.close(reader)
+        Handler("third ")([])  # reader is gone
+        Handler("fourth ")([])  # and still not back
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        Handler("fifth")([])
+        self.assertEqual(os.read(reader, 100), "third fourth fifth")
+        os.close(reader)
+        Writer.close_all()
+        os.unlink(path)
+
+    def test_shellhandler(self):
+        directory = mkdtemp()
+        Handler = HandlerFactory("shell", {"user": getpwuid(os.getuid()).pw_name, "timeout": "0.5"})
+        Handler("printf %s {0} > " + directory + "/out")(["x'; touch " + directory + "/pwned; '"])
+        with open(directory + "/out") as f:
+            self.assertEqual(f.read(), "x'; touch " + directory + "/pwned; '")
+        self.assertFalse(os.path.exists(directory + "/pwned"))
+        self.assertRaises(HandlerTimeout, Handler("sleep 5"), [])
+        # children of the shell are killed as well
+        self.assertRaises(HandlerTimeout, Handler("sleep 7.25 | cat"), [])
+        Event().wait(0.1)
+        self.assertNotIn("sleep 7.25", Popen(["ps", "-eo", "args"], stdout=PIPE).communicate()[0].split("\n"))
+        ShellWorker.stop_all()
+
     def test_clbhandler(self):
         tmp = NamedTemporaryFile(delete=False)
         tmp.file.write("def raise_(): raise FutureWarning\n")
@@ -151,9 +347,435 @@ class HandlerTest(TestCase):
         Handler = HandlerFactory("callback", {"path": tmp.name})
         self.assertRaises(FutureWarning, Handler("raise_()"), [])
         self.assertRaises(FutureWarning, Handler("raise__({0})"), [FutureWarning])
+        self.assertRaises(FutureWarning, Handler("raise__({1})"), [None, FutureWarning])
+        self.assertRaises(FutureWarning, Handler("raise__({})"), [FutureWarning, None])
 
         tmp.unlink(tmp.name)
 
+class PoolTest(TestCase):
+    class BlockingHandler(AbstractHandler):
+        def __init__(self, cmd, params):
+            super(PoolTest.BlockingHandler, self).__init__(cmd, params)
+            self.release = Event()
+            self.calls = []
+
+        def __call__(self, params):
+            self.calls.append(params)
+            self.release.wait(5)
+
+    def test_concurrency(self):
+        pool = HandlerPool(workers=4, queue_size=3)
+        h = self.BlockingHandler("", {"concurrency": "1"})
+        self.assertTrue(all(pool.submit(h, [n]) for n in range(3)))
+        self.assertFalse(pool.submit(h, [3]))
+        self.assertEqual(pool.depth(), 3)
+        self.assertEqual(pool.stats["dropped"], 1)
+        Event().wait(0.1)
+        self.assertEqual(h.calls, [[0]])
+        h.release.set()
+        for i in range(50):
+            if not pool.depth():
+                break
+            Event().wait(0.1)
+        self.assertEqual(h.calls, [[0], [1], [2]])
+        self.assertEqual(pool.stats["done"], 3)
+
+class ProcessorTestCase(TestCase):
+    """
+    processor of a config in temporary directory; button device translates
+    codes without X server, pipe handler of `self.pipe` writes to `output`
+    """
+    def setUp(self):
+        Translator.set_device_type("button")
+        self.directory = mkdtemp()
+        self.pipe = "pipe path=%s/out mode=a" % self.directory
+
+    def tearDown(self):
+        Writer.close_all()
+        Translator.set_device_type("key")
+        rmtree(self.directory)
+
+    def config(self, expressions, **settings):
+        path = self.directory + "/test.conf"
+        with open(path, "w") as f:
+            f.write(dumps({
+                "processor": dict({"reset_key": "<1>", "input_end_key": "<TOUCH>"}, **settings),
+                "expressions": expressions,
+            }))
+        return path
+
+    def processor(self, expressions, **settings):
+        return Processor(self.config(expressions, **settings), start=False)
+
+    def drain(self, processor):
+        for i in range(50):
+            if not processor.pool.depth():
+                break
+            Event().wait(0.1)
+
+    def output(self):
+        Writer.close_all()
+        with open(self.directory + "/out") as f:
+            return f.read()
+
+class RecordTest(ProcessorTestCase):
+    def test_replay(self):
+        log = self.directory + "/log"
+        events = [KeyRecord(code, 1, 10, 500000 * n) for n, code in enumerate([256, 258, 259, 330])]
+        recorder = Recorder(log)
+        for event in events:
+            recorder.write(0, event)
+        recorder.close()
+        self.assertEqual(list(read_log(log)), [(e.sec, e.usec, 0, e.scancode, e.keystate) for e in events])
+
+        # replay of daemon's own log must not write over it
+        p = self.processor({"default": {self.pipe: {"<0>*": "{0}"}}}, record=log)
+        p.add_session()
+        count, took = replay(p, log, speed=10)
+        self.assertEqual(count, 4)
+        self.assertTrue(took >= 0.15)
+        self.drain(p)
+        self.assertEqual(self.output(), "<2><3>")
+
+class CacheTest(ProcessorTestCase):
+    def test_cache(self):
+        path = self.directory + "/cache"
+        expressions = {"default": {self.pipe: {"<0>*<2>": "{0}", "[<3><4>]": "chord ", "<0><5>": "five "}}}
+        compiled = self.processor(expressions, cache=path).namespaces["default"]
+        cache = MatcherCache(path)
+        self.assertIsNotNone(cache.get("default", expressions["default"], "<TOUCH>"))
+        p = self.processor(expressions, cache=path)
+        loaded = p.namespaces["default"]
+        self.assertFalse(p.cache.changed)
+        self.assertEqual(loaded.tables(), compiled.tables())
+        self.assertEqual([e.tokens for e, h in loaded.bindings], [e.tokens for e, h in compiled.bindings])
+        self.assertEqual(loaded.gestures.chords, set([(259, 260)]))
+        session = p.add_session()
+        for code in [256, 262, 330, 258, 256, 261]:
+            p.handle_event(KeyEvent(InputEvent(0, 0, 1, code, 1)), session)
+        self.drain(p)
+        self.assertEqual(self.output(), "<6>five ")
+        # changed namespace, end key or device type are compiled again
+        self.assertIsNone(cache.get("default", {self.pipe: {"<0>*<2>": "{0}"}}, "<TOUCH>"))
+        self.assertIsNone(cache.get("default", expressions["default"], "<ENTER>"))
+        Translator.set_device_type("key")
+        self.assertIsNone(cache.get("default", expressions["default"], "<TOUCH>"))
+
+class MetricsTest(ProcessorTestCase):
+    def test_metrics(self):
+        path = self.directory + "/metrics"
+        p = self.processor({"default": {"dummy": {"<0><2>": ""}}}, metrics_socket=path)
+        self.assertIsNone(p.metrics_server)
+        p.init_servers()
+        # socket of a running process is not taken over
+        self.assertRaises(SocketError, unix_server, path)
+        session = p.add_session()
+        for code in [256, 258, 256]:
+            p.handle_event(KeyEvent(InputEvent(0, 0, 1, code, 1)), session)
+        self.drain(p)
+        # client that sends nothing does not hold the loop up
+        idle = socket(AF_UNIX, SOCK_STREAM)
+        idle.connect(path)
+        client = socket(AF_UNIX, SOCK_STREAM)
+        client.connect(path)
+        client.sendall("GET /metrics HTTP/1.0\r\n\r\n")
+        for i in range(10):
+            for fd, mask in p.poller.poll(0.1):
+                p.listeners[fd]()
+        response = "".join(iter(lambda: client.recv(4096), ""))
+        p.exit()
+        self.assertTrue(response.startswith("HTTP/1.0 200 OK"))
+        for line in ['pybd_keys_total{result="accept"} 1', 'pybd_keys_total{result="partial"} 2',
+                     'pybd_matches_total{expression="<0><2>",namespace="default"} 1',
+                     'pybd_buffer_depth{device="none"} 1',
+                     'pybd_handler_runs_total{handler="dummy",outcome="done"} 1',
+                     'pybd_handler_seconds_bucket{handler="dummy",le="+Inf"} 1']:
+            self.assertIn(line + "\n", response)
+        self.assertFalse(os.path.exists(path))
+
+class TimerWheelTest(TestCase):
+    def test_wheel(self):
+        wheel = TimerWheel(tick=0.01, size=8)
+        fired = []
+        self.assertEqual(wheel.timeout(100), -1)
+        timers = [wheel.schedule(100 + delay, fired.append) for delay in [0.5, 0.02, 0.2, 0.021]]
+        self.assertAlmostEqual(wheel.timeout(100), 0.02)
+        wheel.cancel(timers[2])
+        wheel.expire(100.0205)
+        self.assertEqual(fired, [100.02])
+        wheel.expire(101)
+        self.assertEqual(fired, [100.02, 100.021, 100.5])
+        self.assertEqual(wheel.timeout(101), -1)
+
+class GestureTest(ProcessorTestCase):
+    def press(self, processor, keys):
+        """feeds (seconds, code, state) keys, running timers on their time"""
+        session = processor.add_session()
+        for when, code, state in keys:
+            processor.timers.expire(100 + when)
+            processor.handle_event(KeyRecord(code, state, 100 + int(when), int(when % 1 * 1000000)), session)
+        processor.timers.expire(200)
+        self.drain(processor)
+
+    def test_gestures(self):
+        # one worker keeps order of runs of different handlers
+        p = self.processor({"default": {self.pipe: {
+            "[<2><3>]": "chord ", "[<2><3><4>]": "chord3 ", "<2><3>": "sequence ",
+            "<5>~": "hold ", "<5>~1000": "long hold ", "<5>": "press ", "<5>^2": "double ",
+            "<6>": "plain ",
+        }}}, hold_time=400, workers=1)
+        self.press(p, [(0, 258, 1), (0.01, 259, 1), (0.1, 258, 0), (0.1, 259, 0),
+                       (1, 258, 1), (1.01, 259, 1), (1.02, 260, 1), (1.1, 258, 0), (1.1, 259, 0), (1.1, 260, 0),
+                       (2, 258, 1), (2.1, 258, 0), (2.2, 259, 1), (2.3, 259, 0),
+                       (3, 261, 1), (3.1, 261, 0), (4, 261, 1), (4.5, 261, 0),
+                       (5, 261, 1), (6.5, 261, 0), (7, 261, 1), (7.1, 261, 0), (7.2, 261, 1), (7.3, 261, 0),
+                       (8, 262, 1), (8, 262, 0)])
+        self.assertEqual(self.output(), "chord chord3 sequence press hold hold long hold double plain ")
+
+    def test_rollover(self):
+        p = self.processor({"default": {self.pipe: {
+            "[<2><3>]": "chord ", "<2><4>": "seq24 ", "<5>~": "hold ", "<5><6>": "seq56 ",
+            "<7>^2": "double ", "<7><6>": "seq76 ",
+        }}}, workers=1)
+        # next key is pressed before previous one is released
+        self.press(p, [(0, 258, 1), (0.01, 260, 1), (0.02, 258, 0), (0.03, 260, 0),
+                       (1, 261, 1), (1.01, 262, 1), (1.02, 261, 0), (1.03, 262, 0),
+                       (2, 263, 1), (2.01, 263, 0), (2.02, 262, 1), (2.03, 262, 0)])
+        self.assertEqual(self.output(), "seq24 seq56 seq76 ")
+
+class LimiterTest(TestCase):
+    def test_params(self):
+        handler = DummyHandler("", {"debounce": "50ms", "max_rate": "30/m", "policy": "last"})
+        self.assertEqual((handler.limiter.debounce, handler.limiter.count, handler.limiter.period,
+                          handler.limiter.policy), (0.05, 30, 60, "last"))
+        self.assertEqual(DummyHandler("", {"max_rate": "10/5s"}).limiter.period, 5)
+        self.assertEqual(DummyHandler("", {"debounce": "20"}).limiter.debounce, 0.02)
+        self.assertIsNone(DummyHandler("", {}).limiter)
+        self.assertRaises(ValueError, DummyHandler, "", {"max_rate": "5", "policy": "all"})
+
+    def test_policies(self):
+        Limiter.wheel = TimerWheel()
+        triggers = [100, 100.01, 100.3, 100.4, 100.45, 100.5, 101.6]
+        results = {}
+        for policy in Limiter.policies:
+            limiter = Limiter(0.1, 2, 1, policy)
+            runs, actions = [], []
+            for i, now in enumerate(triggers):
+                Limiter.wheel.expire(now)
+                actions.append(limiter.submit(now, lambda i=i: runs.append(i)))
+            Limiter.wheel.expire(200)
+            results[policy] = runs, actions
+        self.assertEqual(results["drop"], ([0, 2, 6], [None, "dropped", None, "dropped", "dropped", "dropped", None]))
+        self.assertEqual(results["queue"], ([0, 1, 2, 3, 4, 5, 6],
+                                            [None, "delayed", "delayed", "delayed", "delayed", "delayed", "delayed"]))
+        limiter = Limiter(0.1)
+        for i in range(100):
+            limiter.submit(i, lambda: None)
+        self.assertEqual(len(limiter.runs), 1)
+        self.assertEqual(results["last"], ([0, 1, 5, 6], [None, "delayed", "delayed", "replaced", "replaced", "replaced", None]))
+
+class ControlTest(ProcessorTestCase):
+    def test_commands(self):
+        path = self.directory + "/control"
+        p = self.processor({"default": {self.pipe: {"<0><2>": "hit "}}, "media": {}}, control_socket=path)
+        p.init_servers()
+        p.add_session()
+        self.assertEqual(os.stat(path).st_mode & 0777, 0600)
+        client = socket(AF_UNIX, SOCK_STREAM)
+        client.connect(path)
+        p.control.accept()
+        connection = p.control.connections[0]
+
+        def send(line):
+            client.sendall(line)
+            connection.ready()
+            return loads(client.recv(65536))
+
+        self.assertEqual(send('{"cmd": "press", "keys": "<0><2><0>"}\n'), {"ok": 3})
+        # batch, coming in two parts
+        client.sendall('[{"cmd": "state"}, ')
+        connection.ready()
+        replies = send('{"cmd": "namespace", "name": "nowhere"}]\n')
+        self.assertEqual(replies[0]["ok"]["devices"][0]["buffer"], [["2", 0], ["0", 1], ["0", 0]])
+        self.assertTrue("no namespace nowhere" in replies[1]["error"])
+        self.assertEqual(send('{"cmd": "namespace", "name": "media"}\n'), {"ok": "media"})
+        self.assertTrue("no such command" in send('{"cmd": "fly"}\n')["error"])
+        # client not reading its replies does not block the loop
+        client.sendall('{"cmd": "state"}\n' * 2000)
+        connection.ready()
+        self.assertTrue(connection.output)
+        client.setblocking(False)
+        replies = ""
+        while replies.count("\n") < 2000:
+            connection.ready()
+            try:
+                replies += client.recv(65536)
+            except SocketError:
+                pass
+        self.drain(p)
+        p.exit()
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(self.output(), "hit ")
+
+class NamespaceTest(ProcessorTestCase):
+    def test_switch(self):
+        p = self.processor({
+            "default": {"namespace": {"<0>": "media", "<3>": "nowhere"}, self.pipe: {"<2>": "default "}},
+            "media": {"namespace": {"<0>": "default"}, self.pipe: {"<2>": "media "}},
+        }, namespace_cache=1)
+        session = p.add_session()
+        for code in [258, 259, 258, 256, 258, 256, 258]:
+            p.handle_event(KeyEvent(InputEvent(0, 0, 1, code, 1)), session)
+            # media is compiled on demand and default is dropped from cache
+            if code == 256:
+                self.assertEqual(p.namespaces.keys(), [session.namespace])
+        self.drain(p)
+        self.assertEqual(self.output(), "default default media default ")
+
+    def test_limiter_close(self):
+        pipe = self.pipe + " debounce=1s policy=last"
+        p = self.processor({"default": {"namespace": {"<0>": "media"}, pipe: {"<2>": "a "}},
+                            "media": {pipe: {"<2>": "b "}}}, namespace_cache=1)
+        session = p.add_session()
+        press = lambda sec, code: p.handle_event(KeyEvent(InputEvent(sec, 0, 1, code, 1)), session)
+        limiter_of = lambda cmd: [handler for expression, handler in p.compiled["default"].values()
+                               if handler.cmd == cmd][0].limiter
+        press(0, 258)
+        press(0, 258)
+        limiter = limiter_of("a ")
+        self.assertTrue(limiter.timer)
+        # handler not bound after reload drops its delayed run
+        self.config({"default": {"namespace": {"<0>": "media"}, pipe: {"<2>": "c "}},
+                     "media": {pipe: {"<2>": "b "}}}, namespace_cache=1)
+        p.reload()
+        self.assertIsNone(limiter.timer)
+        press(5, 258)
+        press(5, 258)
+        limiter = limiter_of("c ")
+        # and so does handler of namespace dropped from cache
+        press(6, 256)
+        self.assertEqual(p.compiled.keys(), ["media"])
+        self.assertIsNone(limiter.timer)
+        p.timers.expire(10)
+        self.drain(p)
+        self.assertEqual(self.output(), "a c ")
+
+class ReloadTest(ProcessorTestCase):
+    def test_reload(self):
+        expressions = {"default": {self.pipe: {"<2>": "a ", "<3>": "b ", "<4><5>": "seq "}}}
+        p = self.processor(expressions)
+        session = p.add_session()
+        press = lambda code: p.handle_event(KeyEvent(InputEvent(0, 0, 1, code, 1)), session)
+        handlers = lambda: dict((handler.cmd, handler) for expression, handler in p.compiled["default"].values())
+        old = handlers()
+        press(260)
+        # settings not compiled into expressions keep handlers too
+        expressions["default"][self.pipe]["<3>"] = "c "
+        self.config(expressions, buffer_size=128)
+        p.reload()
+        new = handlers()
+        self.assertIs(new["a "], old["a "])
+        self.assertIs(new["seq "], old["seq "])
+        self.assertNotIn(new["c "], old.values())
+        self.assertEqual(p.buffer_size, 128)
+        # partially typed input survives
+        press(261)
+        press(259)
+        # broken config keeps the old state
+        with open(p.config_path, "w") as f:
+            f.write("{")
+        p.reload()
+        self.assertIs(handlers()["c "], new["c "])
+        self.assertEqual(p.buffer_size, 128)
+        press(258)
+        self.drain(p)
+        self.assertEqual(self.output(), "seq c a ")
+
+class DevicesTest(ProcessorTestCase):
+    def test_sessions(self):
+        pipes = {}
+
+        class PipeDevice(Device):
+            """pipe, as in EventReaderTest, in place of evdev device"""
+            def __init__(self, path):
+                self.path, self.initial_state = path, None
+                read, pipes[path] = os.pipe()
+                fcntl(read, F_SETFL, os.O_NONBLOCK)
+                self.listener = os.fdopen(read)
+                self.reader = EventReader(read, lambda: [])
+
+        path = self.config({"default": {}, "one": {self.pipe: {"<2><3>": "one "}},
+                            "two": {self.pipe: {"<2><4>": "two "}}}, workers=1)
+        with open(path) as f:
+            config = loads(f.read())
+        config["devices"] = [{"path": "a", "namespace": "one"}, {"path": "b", "namespace": "two"}]
+        with open(path, "w") as f:
+            f.write(dumps(config))
+        p = Processor(path, start=False)
+        pybd.processor.Device = PipeDevice
+        try:
+            p.init_device()
+        finally:
+            pybd.processor.Device = Device
+        # keys of devices interleave, each is matched in its own buffer
+        for path, code in [("a", 258), ("b", 258), ("a", 259), ("b", 260)]:
+            os.write(pipes[path], "".join(EventReader.event.pack(*event)
+                                          for event in [(1, 0, 1, code, 1), (1, 0, 0, 0, 0)]))
+            for fd, mask in p.poller.poll(0.1):
+                p.listeners[fd]()
+        self.assertEqual([(s.namespace, s.device.path) for s in p.sessions], [("one", "a"), ("two", "b")])
+        self.drain(p)
+        p.exit()
+        self.assertNotIn(p.display_hook, Translator.display_hooks)
+        for device in p.devices:
+            device.listener.close()
+            os.close(pipes[device.path])
+        self.assertEqual(self.output(), "one two ")
+
+class BufferTest(ProcessorTestCase):
+    def test_limits(self):
+        p = self.processor({"default": {"dummy": {"<0>*": ""}}}, buffer_size=4, idle_timeout=5)
+        session = p.add_session()
+        key = lambda sec, code: KeyRecord(code, 1, sec)
+        for event in [key(0, 256), key(1, 258), key(2, 259)]:
+            p.handle_event(event, session)
+        self.assertEqual(len(session.event_buffer), 3)
+        # user came back after a while
+        p.handle_event(key(10, 256), session)
+        self.assertEqual(len(session.event_buffer), 1)
+        for event in [key(11, 258), key(12, 259), key(13, 260), key(14, 256)]:
+            p.handle_event(event, session)
+        self.assertEqual(len(session.event_buffer), 1)
+        # evdev events are taken as well
+        p.handle_event(KeyEvent(InputEvent(30, 0, 1, 256, 1)), session)
+        self.assertEqual(len(session.event_buffer), 1)
+
+class StartupTest(ProcessorTestCase):
+    def test_background_compile(self):
+        class OneShot(Processor):
+            def init_device(self):
+                session = self.add_session()
+                # keys read before expressions are ready
+                self.backlog += [(KeyEvent(InputEvent(0, 0, 1, code, 1)), session) for code in [256, 258]]
+
+            def run(self):
+                for fd, mask in self.poller.poll(5):
+                    self.listeners[fd]()
+
+        p = OneShot(self.config({"default": {self.pipe: {"<0><2>": "hit"}}}))
+        self.assertEqual(p.backlog, None)
+        self.assertEqual([phase for phase, took in p.timings], ["logging", "pool", "devices", "expressions"])
+        self.drain(p)
+        self.assertEqual(self.output(), "hit")
+
+class TracerTest(TestCase):
+    def test_sample(self):
+        tracer = Tracer(sample=2)
+        key = KeyEvent(InputEvent(0, 0, 1, 30, 1))
+        records = [tracer.start(key, [key]) for i in range(4)]
+        self.assertEqual([r and r["seq"] for r in records], [None, 2, None, 4])
+        self.assertEqual(records[1]["buffer"], [("a", 1)])
+
 class TranslationTest(TestCase):
     def test_char_to_code(self):
         Translator.set_device_type("key")
@@ -163,6 +785,14 @@ class TranslationTest(TestCase):
         Translator.set_device_type("button")
         self.assertEqual(Translator.char_to_code("TOUCH"), 330)
 
+    def test_key_to_name(self):
+        Translator.set_device_type("key")
+        self.assertEqual(Translator.key_to_name(30), "A")
+        self.assertEqual(Translator.key_to_name(KeyEvent(InputEvent(0, 0, 1, 30, 1))), "a")
+        Translator.set_device_type("button")
+        self.assertEqual(Translator.key_to_name(256), "0")
+        Translator.set_device_type("key")
+
     def test_code_to_chat(self):
         Translator.set_device_type("key")
         matches = {"a": 30, "\r": 28}